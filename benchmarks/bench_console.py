@@ -0,0 +1,103 @@
+"""Compare the console parsers on big synthetic skt pipeline logs
+
+Usage: python benchmarks/bench_console.py [--sizes-mb 10 100 300]
+
+get_sections plus parse_section need the whole consoleText in memory while
+ConsoleParser is fed the lines of the file one at a time, like it is fed the
+lines of the streamed response by sss_jenkins.
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Run from a checkout, sss does not need to be installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import sss  # noqa: E402
+
+SKT_RC = """[state]
+basehead = e96d38e6e7ae0ee35656fc86a0668434648bb8e3
+baserepo = git://git.kernel.org/pub/scm/linux/kernel/git/torvalds/linux.git
+patchwork_00 = http://patchwork.example.com/patch/229746
+cfgurl = http://builds.example.com/{arch}.config
+buildurl = http://builds.example.com/{arch}.tar.gz
+recipesetid_0 = beaker:{build}"""
+FILLER = ('  CC      drivers/net/ethernet/intel/e1000e/netdev.o'
+          ' [build output of the pipeline]\n')
+
+
+def write_section(fh, name, build, arches):
+    fh.write('[Pipeline] stage\n[Pipeline] {{ ({})\n'.format(name))
+    fh.write('BUILD STATE after {}\n'.format(name))
+    for arch in arches:
+        fh.write('[Pipeline] echo\n{}:\n'.format(arch))
+        fh.write('status: Passed\nskt configuration:\n')
+        fh.write(SKT_RC.format(arch=arch, build=build) + '\n')
+    fh.write('[Pipeline] }\n')
+
+
+def write_console(path, size, arches=sss.DEFAULT_ARCHES):
+    """Write a console of about size bytes, made of 3 sections per build"""
+    filler = FILLER * 1000
+    build = 0
+    with open(path, 'w') as fh:
+        while fh.tell() < size:
+            for name in ('MERGE', 'BUILD', 'TESTING'):
+                fh.write(filler)
+                write_section(fh, name, build, arches)
+            build += 1
+
+
+def legacy(path):
+    with open(path) as fh:
+        sections = sss.get_sections(fh.read())
+    return len(sections), len(sss.parse_section(sections['TESTING']))
+
+
+def streaming(path):
+    parser = sss.ConsoleParser()
+    with open(path) as fh:
+        records = [d for name, d in parser.parse(fh) if name == 'TESTING']
+    return len(parser.sections), len(records)
+
+
+def measure(func, path):
+    tracemalloc.start()
+    start = time.time()
+    result = func(path)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes-mb', type=int, nargs='+',
+                        default=[10, 100, 300])
+    args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('{:>8} {:>10} {:>10} {:>12}'.format('size MB', 'parser',
+                                                  'seconds', 'peak MB'))
+        for size in args.sizes_mb:
+            path = os.path.join(tmpdir, 'consoleText')
+            write_console(path, size * 1024 * 1024)
+            results = set()
+            for func in (legacy, streaming):
+                result, elapsed, peak = measure(func, path)
+                results.add(result)
+                print('{:>8} {:>10} {:>10.2f} {:>12.1f}'.format(
+                    size, func.__name__, elapsed, peak / 1024.0 / 1024.0))
+            assert len(results) == 1, results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+"""Measure sss_jenkins and post_test_info against local fake servers
+
+Usage: python benchmarks/bench_sync.py [--scenarios small slow-beaker]
+                                       [--workers 4] [--log-kb 1024 ...]
+
+A Jenkins, a Beaker and a Squad server run into this process and generate
+the builds, consoles, recipesets, recipe XMLs and logs of each scenario at
+the sizes and latencies it sets, every option but --scenarios and --workers
+overrides that field of all the scenarios run.  sss runs into a process of
+its own per scenario, so that the peak RSS reported is the one of the
+scenario.
+"""
+from __future__ import print_function
+import argparse
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Run from a checkout, sss does not need to be installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import sss  # noqa: E402
+from bench_console import FILLER, SKT_RC  # noqa: E402
+
+Scenario = collections.namedtuple('Scenario', [
+    'command',  # sss_jenkins or post_test_info
+    'jobs',
+    'builds',  # per job
+    'console_kb',  # per section of a console
+    'recipes',  # per recipeset, every arch of a build has its recipeset
+    'tasks',  # per recipe, after /distribution/kpkginstall
+    'tests',  # per task
+    'log_kb',
+    'jenkins_latency_ms',
+    'beaker_latency_ms',
+    'squad_latency_ms',
+])
+SCENARIOS = collections.OrderedDict([
+    ('small', Scenario('sss_jenkins', 2, 10, 64, 1, 2, 2, 4, 0, 0, 0)),
+    ('big-console', Scenario('sss_jenkins', 1, 4, 32 * 1024, 1, 1, 1, 4,
+                             0, 0, 0)),
+    ('many-logs', Scenario('sss_jenkins', 1, 4, 64, 2, 10, 5, 256,
+                           0, 0, 0)),
+    ('slow-beaker', Scenario('sss_jenkins', 2, 5, 64, 1, 4, 2, 4,
+                             5, 100, 20)),
+    ('post-test-info', Scenario('post_test_info', 1, 10, 0, 2, 4, 2, 16,
+                                0, 20, 20)),
+])
+JOB_NAME = 'bench-job-{}'
+JOB_BUILDS_APART = 100000
+
+
+def _recipeset_id(job, number, arch):
+    return '{}.{}.{}'.format(job, number, arch)
+
+
+class FakeServers(object):
+    """The Jenkins, Beaker and Squad of a scenario, counting their requests"""
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.started = int(time.time() * 1000)
+        self.requests = collections.Counter()
+        self.bytes = collections.Counter()
+        self._lock = threading.Lock()
+        self._servers = {}
+        for service in ('jenkins', 'beaker', 'squad'):
+            server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+            server.daemon_threads = True
+            server.service = service
+            server.bench = self
+            self._servers[service] = server
+
+    def url(self, service):
+        return 'http://127.0.0.1:{}'.format(
+            self._servers[service].server_address[1])
+
+    def start(self):
+        for server in self._servers.values():
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        for server in self._servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def account(self, service, size):
+        with self._lock:
+            self.requests[service] += 1
+            self.bytes[service] += size
+
+    def latency(self, service):
+        return getattr(self.scenario, service + '_latency_ms') / 1000.0
+
+    def jenkins(self, path, query):
+        parts = path.strip('/').split('/')
+        if len(parts) < 3 or parts[0] != 'job':
+            return None
+        job = int(parts[1].rsplit('-', 1)[1])
+        if parts[2:] == ['api', 'json']:
+            tree = query.get('tree', [''])[0]
+            # Step job_ids do not include the job name, so every job has
+            # builds numbered apart
+            first = job * JOB_BUILDS_APART
+            numbers = range(first + self.scenario.builds, first, -1)
+            if '{' in tree:
+                start, stop = tree.split('{')[1].rstrip('}').split(',')
+                numbers = numbers[int(start):int(stop)]
+            key = 'allBuilds' if tree.startswith('allBuilds') else 'builds'
+            return json.dumps({key: [{
+                'number': number,
+                'id': str(number),
+                'url': '{}/job/{}/{}'.format(self.url('jenkins'), parts[1],
+                                             number),
+                'building': False,
+                'result': 'SUCCESS',
+                'timestamp': self.started + number * 60000,
+            } for number in numbers]})
+        if parts[3:] == ['consoleText']:
+            return self.console(job, int(parts[2]))
+        return None
+
+    def console(self, job, number):
+        filler = FILLER * (self.scenario.console_kb * 1024 // len(FILLER))
+        lines = []
+        for name in ('MERGE', 'BUILD', 'TESTING'):
+            lines.append(filler)
+            lines.append('[Pipeline] stage\n[Pipeline] {{ ({})\n'
+                         'BUILD STATE after {}\n'.format(name, name))
+            for arch in sss.DEFAULT_ARCHES:
+                lines.append('[Pipeline] echo\n{}:\n'
+                             'status: Passed\nskt configuration:\n'
+                             '{}\n'.format(arch, SKT_RC.format(
+                                 arch=arch,
+                                 build=_recipeset_id(job, number, arch),
+                             )))
+            lines.append('[Pipeline] }\n')
+        return ''.join(lines)
+
+    def beaker(self, path, query):
+        parts = path.strip('/').split('/')
+        if parts[0] == 'recipesets' and len(parts) == 2:
+            return self.recipeset(parts[1])
+        if parts[0] == 'recipes' and len(parts) == 2:
+            return self.recipe(parts[1][:-len('.xml')])
+        if parts[0] == 'logs':
+            return 'x' * (self.scenario.log_kb * 1024)
+        return None
+
+    def _tasks(self, recipe_id):
+        return [('{}.{}'.format(recipe_id, task),
+                 '/kernel/bench{}'.format(task))
+                for task in range(self.scenario.tasks)]
+
+    def recipeset(self, recipeset_id):
+        recipes = []
+        for recipe in range(self.scenario.recipes):
+            recipe_id = '{}.{}'.format(recipeset_id, recipe)
+            recipes.append({
+                'recipe_id': recipe_id,
+                'status': 'Completed',
+                'tasks': [{
+                    'id': task_id,
+                    'name': name,
+                    'status': 'Completed',
+                    'start_time': '2018-01-01 10:00:00',
+                    'finish_time': '2018-01-01 10:42:00',
+                    'logs': [{
+                        'path': 'taskout.log',
+                        'href': 'logs/{}/taskout.log'.format(task_id),
+                    }],
+                } for task_id, name in self._tasks(recipe_id)],
+            })
+        return json.dumps({'machine_recipes': recipes})
+
+    def recipe(self, recipe_id):
+        xml = ['<job><recipeSet><recipe id="{}" status="Completed">'
+               '<task name="/distribution/kpkginstall"/>'.format(recipe_id)]
+        for task_id, name in self._tasks(recipe_id):
+            xml.append('<task name="{}" id="{}"><results>'.format(name,
+                                                                  task_id))
+            for test in range(self.scenario.tests):
+                xml.append(
+                    '<result path="{name}/test{test}" result="Pass"'
+                    ' id="{task_id}.{test}"><logs><log href="{url}/logs/'
+                    '{task_id}/test{test}.log"/></logs></result>'.format(
+                        url=self.url('beaker'), **locals()))
+            xml.append('</results></task>')
+        xml.append('</recipe></recipeSet></job>')
+        return ''.join(xml)
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Keep-alive, as Jenkins, Beaker and Squad do
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        bench = self.server.bench
+        time.sleep(bench.latency(self.server.service))
+        parts = urlsplit(self.path)
+        body = getattr(bench, self.server.service)(parts.path,
+                                                   parse_qs(parts.query))
+        if body is None:
+            bench.account(self.server.service, 0)
+            return self._respond(404)
+        body = body.encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            bench.account(self.server.service, 0)
+            return self._respond(304, headers=[('ETag', etag)])
+        bench.account(self.server.service, len(body))
+        self._respond(200, body, [('ETag', etag)])
+
+    def do_POST(self):
+        bench = self.server.bench
+        size = int(self.headers.get('Content-Length', 0))
+        left = size
+        while left:
+            left -= len(self.rfile.read(min(left, 64 * 1024)))
+        time.sleep(bench.latency(self.server.service))
+        bench.account(self.server.service, size)
+        self._respond(201)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_sss_jenkins(scenario, workers):
+    with open('config.py', 'w') as fh:
+        fh.write('JOB_NAMES_TRACKED = {!r}\n'.format(
+            [JOB_NAME.format(job) for job in range(scenario.jobs)]))
+    sys.path.insert(0, os.getcwd())
+    sys.argv = ['sss_jenkins', '--workers', str(workers),
+                '--metrics-file', 'metrics.json']
+    sss.process_jenkins_jobs()
+
+
+def run_post_test_info(scenario, workers):
+    os.environ['SSS_TASK_WORKERS'] = str(workers)
+    for job in range(scenario.jobs):
+        for number in range(1, scenario.builds + 1):
+            for arch in sss.DEFAULT_ARCHES:
+                with open('skt_rc', 'w') as fh:
+                    fh.write(SKT_RC.format(
+                        arch=arch, build=_recipeset_id(job, number, arch)))
+                sss.post_test_info(JOB_NAME.format(job), arch,
+                                   '{}.{}'.format(job, number), 'skt_rc',
+                                   {'build_url': 'bench'})
+
+
+def run_scenario(scenario, workers, workdir, env, queue):
+    """Run sss into workdir and queue its duration and peak RSS in MiB"""
+    try:
+        os.chdir(workdir)
+        os.environ.update(env)
+        start = time.time()
+        globals()['run_' + scenario.command](scenario, workers)
+        elapsed = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in KiB, but in bytes on macOS
+        peak /= 1024.0 ** 2 if sys.platform == 'darwin' else 1024.0
+        queue.put((elapsed, peak, None))
+    except BaseException as e:
+        queue.put((None, None, repr(e)))
+        raise
+
+
+def measure(scenario, workers):
+    servers = FakeServers(scenario)
+    servers.start()
+    workdir = tempfile.mkdtemp()
+    env = {
+        'JENKINS_HOST': servers.url('jenkins'),
+        'JENKINS_USERNAME': 'bench',
+        'JENKINS_PASSWORD': 'bench',
+        'BEAKER_HOST': servers.url('beaker'),
+        'SQUAD_HOST': servers.url('squad'),
+        'AUTH_TOKEN': 'bench',
+        'SSS_BEAKER_CACHE_DIR': os.path.join(workdir, 'beaker_cache'),
+        'LOG_LEVEL': 'WARNING',
+    }
+    try:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=run_scenario,
+            args=(scenario, workers, workdir, env, queue),
+        )
+        process.start()
+        elapsed, peak, error = queue.get()
+        process.join()
+    finally:
+        servers.stop()
+        shutil.rmtree(workdir)
+    if error:
+        raise RuntimeError(error)
+    return elapsed, peak, servers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS),
+                        default=list(SCENARIOS))
+    parser.add_argument('--workers', type=int, default=4)
+    for field in Scenario._fields[1:]:
+        parser.add_argument('--' + field.replace('_', '-'), type=int)
+    args = parser.parse_args()
+    overrides = dict((field, getattr(args, field))
+                     for field in Scenario._fields[1:]
+                     if getattr(args, field) is not None)
+    print('{:>15} {:>7} {:>8} {:>9} {:>8} {:>8} {:>8} {:>8} {:>9}'.format(
+        'scenario', 'builds', 'seconds', 'builds/s', 'peak MB', 'jenkins',
+        'beaker', 'squad', 'squad MB'))
+    for name in args.scenarios:
+        scenario = SCENARIOS[name]._replace(**overrides)
+        elapsed, peak, servers = measure(scenario, args.workers)
+        builds = scenario.jobs * scenario.builds
+        print('{:>15} {:>7} {:>8.2f} {:>9.2f} {:>8.1f} {:>8} {:>8} {:>8}'
+              ' {:>9.1f}'.format(
+                  name, builds, elapsed, builds / elapsed, peak,
+                  servers.requests['jenkins'], servers.requests['beaker'],
+                  servers.requests['squad'],
+                  servers.bytes['squad'] / 1024.0 / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
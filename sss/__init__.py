@@ -1,20 +1,44 @@
 from __future__ import division
 import os
 import argparse
+import contextlib
+import errno
+import gzip
+import hashlib
+import heapq
+import io
 import json
 import logging
 import tempfile
 import shutil
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+import zlib
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 try:
     import ConfigParser as configparser
 except ImportError:
     import configparser
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
 import requests
-import dateutil.parser
-import xmltodict
-import jenkins
-import pickledb
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+# jenkins, dateutil and http.server are imported by the functions using
+# them, most sss invocations post a single merge or build step and need none
+# of them
 
 
 MERGE_FIELDS_REQUIRED = [
@@ -26,6 +50,43 @@ BUILD_FIELDS_REQUIRED = [
     'cfgurl',
     'buildurl|buildlog',
 ]
+# A job lease outlives the process syncing it only if this one dies
+JOB_LEASE_TTL = 6 * 3600
+# Status of the skt pipelines
+STATUS_MAP = {
+    'Created': 'Patching fail',
+    'Merged': 'Building fail',
+    'Built': 'Testing fail weirdly',
+    'Tested': 'Testing fail',
+    'Passed': 'OK',
+}
+MERGE_FAIL_STATUS = {
+    'Created': 'fail',
+}
+BUILD_FAIL_STATUS = {
+    'Created': 'fail',
+    'Merged': 'fail',
+    'Built': 'fail',
+}
+# Status showing the merge, or the build, of a running pipeline passed
+LIVE_MERGED_STATUS = ('Merged', 'Built', 'Tested', 'Passed')
+LIVE_BUILT_STATUS = ('Built', 'Tested', 'Passed')
+# Arches of the skt pipelines, config.ARCHES overrides them
+DEFAULT_ARCHES = ('aarch64', 'ppc64le', 'x86_64', 'ppc64')
+# Beaker of the skt pipelines, BEAKER_HOST overrides it
+DEFAULT_BEAKER_HOST = 'https://beaker.engineering.redhat.com'
+# Beaker recipes in these states do not change anymore
+BEAKER_FINISHED_STATUS = ('Completed', 'Aborted', 'Cancelled')
+# Path of the tasks into a Beaker recipe XML
+RECIPE_PATH = ['job', 'recipeSet', 'recipe']
+# Everything sss needs about the builds of a job in a single Jenkins call,
+# page is empty or a {start,stop} range of the builds, newest first
+JOB_BUILDS_TREE = ('%(folder_url)sjob/%(short_name)s/api/json?tree='
+                   '%(builds_key)s[%(fields)s]%(page)s')
+BUILD_FIELDS = 'number,id,url,building,result,timestamp'
+# Builds per page of a backfill, the pages skipped on resume are bigger
+BACKFILL_PAGE_SIZE = 100
+BACKFILL_SKIP_PAGE_SIZE = 2000
 
 
 class MissingAUTH_TOKEN(Exception):
@@ -59,30 +120,624 @@ def get_varenv_or_raise(name, exception):
     return varenv
 
 
+class Metrics(object):
+    """Time, calls and bytes of the stages of a run, and counters
+
+    Counters named <cache>_hits and <cache>_misses give the hit rate of
+    <cache> in the summary.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.stages = {}
+            self.counters = {}
+
+    def add(self, stage, seconds, size=0):
+        """Account a call of stage which took seconds and moved size bytes"""
+        with self._lock:
+            stats = self.stages.setdefault(
+                stage, {'calls': 0, 'seconds': 0.0, 'bytes': 0}
+            )
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['bytes'] += size
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def count(self, name, value=1, host=None):
+        with self._lock:
+            key = (name, host)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self, limits=None):
+        """Return the metrics as a dict, limits are the host limits"""
+        with self._lock:
+            stages = dict((stage, dict(stats))
+                          for stage, stats in self.stages.items())
+            counters = dict(self.counters)
+            duration = time.time() - self.started
+        totals = {}
+        for (name, host), value in counters.items():
+            totals[name] = totals.get(name, 0) + value
+        hit_rates = {}
+        for name, hits in totals.items():
+            if name.endswith('_hits'):
+                cache = name[:-len('_hits')]
+                lookups = hits + totals.get(cache + '_misses', 0)
+                hit_rates[cache] = hits / lookups if lookups else None
+        by_host = {}
+        for (name, host), value in counters.items():
+            if host is not None:
+                by_host.setdefault(name, {})[host] = value
+        return {
+            'duration': duration,
+            'stages': stages,
+            'counters': totals,
+            'hosts': by_host,
+            'hit_rates': hit_rates,
+            'limits': limits or {},
+        }
+
+    def prometheus(self, limits=None):
+        """Return the metrics in the Prometheus text format"""
+        summary = self.summary(limits)
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append('# TYPE sss_{} {}'.format(name, kind))
+            for labels, value in sorted(samples):
+                lines.append('sss_{}{} {}'.format(
+                    name,
+                    '{%s}' % labels if labels else '',
+                    value if value is not None else 'NaN',
+                ))
+
+        for field in ('calls', 'seconds', 'bytes'):
+            metric('stage_{}_total'.format(field), 'counter',
+                   [('stage="{}"'.format(stage), stats[field])
+                    for stage, stats in summary['stages'].items()])
+        with self._lock:
+            counters = dict(self.counters)
+        for name in sorted(set(name for name, host in counters)):
+            metric('{}_total'.format(name), 'counter',
+                   [('host="{}"'.format(host) if host else '', value)
+                    for (counter, host), value in counters.items()
+                    if counter == name])
+        metric('hit_rate', 'gauge',
+               [('cache="{}"'.format(cache), rate)
+                for cache, rate in summary['hit_rates'].items()])
+        for field in ('limit', 'in_flight'):
+            metric('host_{}'.format(field), 'gauge',
+                   [('host="{}"'.format(host), state[field])
+                    for host, state in summary['limits'].items()])
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class TimedIterator(object):
+    """Iterate over iterable, summing the time and size of its items"""
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.seconds = 0.0
+        self.size = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        try:
+            item = next(self._iterator)
+        finally:
+            self.seconds += time.time() - start
+        self.size += len(item)
+        return item
+
+    next = __next__
+
+
+def serve_metrics(port, limits=None):
+    """Serve METRICS in the Prometheus format on port from a thread
+
+    limits is called to get the host limits of every scrape.
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = METRICS.prometheus(limits and limits()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format, *args)
+
+    server = HTTPServer(('', port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class Profiler(object):
+    """cProfile every thread started while it runs, merged once dumped"""
+    def __init__(self):
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def _profile_thread(self, frame, event, arg):
+        sys.setprofile(None)
+        self._enable()
+
+    def _enable(self):
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            logging.warning('%s not profiled, another profiler is active',
+                            threading.current_thread().name)
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    def start(self):
+        threading.setprofile(self._profile_thread)
+        self._enable()
+
+    def dump(self, path):
+        import pstats
+        threading.setprofile(None)
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+        if profiles:
+            pstats.Stats(*profiles).dump_stats(path)
+
+
+class HostLimiter(object):
+    """Concurrency limit of the requests to a host, adapted with AIMD
+
+    The limit grows by one every limit successful requests and is halved,
+    at most once per second, on connection errors, 429 and 5xx responses.
+    Answers more than latency_factor times slower than the fastest seen
+    shrink it by a tenth.  A Retry-After header holds every request to the
+    host for that long, up to MAX_RETRY_AFTER seconds: urllib3 already
+    waited for it before each retry, the response only gets here once they
+    are exhausted.
+    """
+    DECREASE_INTERVAL = 1
+    MAX_RETRY_AFTER = 120
+
+    def __init__(self, initial=4, minimum=1, maximum=32, latency_factor=4):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self.latency = None
+        self.best_latency = None
+        self.errors = 0
+        self.blocked_until = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                delay = self.blocked_until - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                elif self.in_flight >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    break
+            self.in_flight += 1
+
+    def _decrease(self, factor):
+        now = time.time()
+        if now - self._last_decrease >= self.DECREASE_INTERVAL:
+            self.limit = max(self.minimum, self.limit * factor)
+            self._last_decrease = now
+
+    def release(self, status, elapsed, retry_after=None):
+        """Account for a request done, status is None on connection errors"""
+        with self._cond:
+            self.in_flight -= 1
+            if retry_after:
+                self.blocked_until = max(
+                    self.blocked_until,
+                    time.time() + min(retry_after, self.MAX_RETRY_AFTER))
+            if status is None or status == 429 or status >= 500:
+                self.errors += 1
+                self._decrease(0.5)
+            else:
+                self.latency = (elapsed if self.latency is None
+                                else 0.8 * self.latency + 0.2 * elapsed)
+                self.best_latency = min(self.best_latency or elapsed, elapsed)
+                if self.latency > self.latency_factor * self.best_latency:
+                    self._decrease(0.9)
+                else:
+                    self.limit = min(self.maximum,
+                                     self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def state(self):
+        with self._cond:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'latency': self.latency,
+                'errors': self.errors,
+            }
+
+
+class RateController(object):
+    """A HostLimiter per host, in front of every request sss sends"""
+    def __init__(self, initial=4, maximum=32):
+        self.initial = initial
+        self.maximum = maximum
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, host):
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = HostLimiter(self.initial,
+                                                   maximum=self.maximum)
+            return self._limiters[host]
+
+    def limits(self):
+        """Return the current state of every host limiter, for debugging"""
+        with self._lock:
+            limiters = dict(self._limiters)
+        return dict((host, limiter.state())
+                    for host, limiter in limiters.items())
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After', 0))
+    except ValueError:
+        # Retry-After can be a date too, backing off is enough then
+        return None
+
+
+class ControlledAdapter(HTTPAdapter):
+    """HTTPAdapter waiting for a slot of the host before sending
+
+    A body keeps its connection, and so the slot, until it is read or its
+    response closed, requests reads the ones not streamed after send
+    returns.  The latency accounted is the one of the headers.
+    """
+    def __init__(self, controller, **kwargs):
+        self.controller = controller
+        super(ControlledAdapter, self).__init__(**kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        parts = urlsplit(request.url)
+        limiter = self.controller.limiter(parts.netloc)
+        limiter.acquire()
+        start = time.time()
+        try:
+            response = super(ControlledAdapter, self).send(request, stream,
+                                                           **kwargs)
+        except Exception:
+            limiter.release(None, time.time() - start)
+            METRICS.count('http_errors', host=parts.netloc)
+            raise
+        METRICS.count('http_requests', host=parts.netloc)
+        if response.status_code == 304:
+            METRICS.count('http_not_modified', host=parts.netloc)
+        elif response.status_code >= 400:
+            METRICS.count('http_errors', host=parts.netloc)
+        args = (response.status_code, time.time() - start,
+                _retry_after(response))
+        release_conn = getattr(response.raw, 'release_conn', None)
+        if release_conn is None:
+            limiter.release(*args)
+            return response
+        released = []
+
+        def release():
+            release_conn()
+            if not released:
+                released.append(True)
+                limiter.release(*args)
+        response.raw.release_conn = release
+        return response
+
+
+class HTTPClient(object):
+    """Pooled keep-alive sessions, one per host (Squad, Beaker, Jenkins)
+
+    Every request gets a timeout and is retried with an exponential backoff
+    on connection errors and on 429 and 5xx responses.  Posts to Squad are
+    retried too, Squad refuses a test run whose job_id it already has.  The
+    concurrency of each host is adapted by the RateController.
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    RETRY_METHODS = frozenset(['GET', 'HEAD', 'POST'])
+
+    def __init__(self, pool_size=10, timeout=60, retries=3, backoff=0.5,
+                 concurrency=4, max_concurrency=32):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # More requests in flight than pooled connections would open
+        # connections only to throw them away
+        self.controller = RateController(min(concurrency, pool_size),
+                                         min(max_concurrency, pool_size))
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            pool_size=int(os.environ.get('SSS_HTTP_POOL_SIZE', 10)),
+            timeout=float(os.environ.get('SSS_HTTP_TIMEOUT', 60)),
+            retries=int(os.environ.get('SSS_HTTP_RETRIES', 3)),
+            backoff=float(os.environ.get('SSS_HTTP_BACKOFF', 0.5)),
+            concurrency=int(os.environ.get('SSS_HOST_CONCURRENCY', 4)),
+            max_concurrency=int(os.environ.get('SSS_HOST_MAX_CONCURRENCY',
+                                               32)),
+        )
+
+    def _retry(self):
+        kwargs = {
+            'total': self.retries,
+            'backoff_factor': self.backoff,
+            'status_forcelist': self.RETRY_STATUS,
+            'raise_on_status': False,
+        }
+        try:
+            return Retry(allowed_methods=self.RETRY_METHODS, **kwargs)
+        except TypeError:
+            # urllib3 < 1.26
+            return Retry(method_whitelist=self.RETRY_METHODS, **kwargs)
+
+    def mount(self, session):
+        """Make session use the pool, retries and limits of this client"""
+        adapter = ControlledAdapter(self.controller, pool_connections=1,
+                                    pool_maxsize=self.pool_size,
+                                    max_retries=self._retry())
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def session(self, url):
+        """Return the session shared by every request to the host of url"""
+        parts = urlsplit(url)
+        host = '{}://{}'.format(parts.scheme, parts.netloc)
+        with self._lock:
+            if host not in self._sessions:
+                self._sessions[host] = self.mount(requests.Session())
+            return self._sessions[host]
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """Return the HTTPClient shared by the whole process"""
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HTTPClient.from_env()
+        return _http_client
+
+
+def get_jenkins_server(host, username, password):
+    """Return a Jenkins client using the timeout and retries of sss"""
+    import jenkins
+    http = get_http_client()
+    server = jenkins.Jenkins(host, username=username, password=password,
+                             timeout=http.timeout)
+    http.mount(server._session)
+    return server
+
+
+class MultipartBody(object):
+    """A multipart/form-data body streamed from the attachments on disk
+
+    Attachments are only opened while they are being sent, so memory and
+    file descriptors stay flat whatever their number and size.  The length
+    is known beforehand, so requests sends a Content-Length instead of a
+    chunked body, and every iteration starts over, so retries work.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, fields, files, boundary=None):
+        self.fields = fields
+        self.files = files
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(
+            self.boundary)
+
+    def _part_header(self, name, filename=None):
+        disposition = 'form-data; name="{}"'.format(name)
+        header = ''
+        if filename is not None:
+            disposition += '; filename="{}"'.format(
+                filename.replace('"', '%22'))
+            header = 'Content-Type: application/octet-stream\r\n'
+        header = '--{}\r\nContent-Disposition: {}\r\n{}\r\n'.format(
+            self.boundary, disposition, header)
+        return header.encode('utf-8')
+
+    def _footer(self):
+        return '--{}--\r\n'.format(self.boundary).encode('utf-8')
+
+    def __len__(self):
+        length = len(self._footer())
+        for name, value in self.fields:
+            length += (len(self._part_header(name)) +
+                       len(value.encode('utf-8')) + 2)
+        for name, filepath in self.files:
+            length += (len(self._part_header(name,
+                                             os.path.basename(filepath))) +
+                       os.path.getsize(filepath) + 2)
+        return length
+
+    def __iter__(self):
+        for name, value in self.fields:
+            yield self._part_header(name)
+            yield value.encode('utf-8') + b'\r\n'
+        for name, filepath in self.files:
+            yield self._part_header(name, os.path.basename(filepath))
+            with open(filepath, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(self.CHUNK_SIZE), b''):
+                    yield chunk
+            yield b'\r\n'
+        yield self._footer()
+
+
+_attachment_index = None
+_attachment_index_lock = threading.Lock()
+
+
+def get_attachment_index():
+    """Return the store of the attachments already uploaded, if enabled
+
+    It is kept into the SQLite database at SSS_ATTACHMENT_INDEX and maps
+    each Squad build plus content hash to the first upload of it.
+    """
+    global _attachment_index
+    path = os.environ.get('SSS_ATTACHMENT_INDEX')
+    if not path:
+        return None
+    with _attachment_index_lock:
+        if _attachment_index is None or _attachment_index.path != path:
+            _attachment_index = SqliteStateStore(path)
+        return _attachment_index
+
+
+def _gzip_attachments():
+    return os.environ.get('SSS_GZIP_ATTACHMENTS', '0').lower() in (
+        '1', 'true', 'yes')
+
+
+def _sha256_file(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(LOG_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _gzip_file(filepath):
+    """Write a gzipped copy next to the file, return its path"""
+    gzpath = filepath + '.gz'
+    with open(filepath, 'rb') as src, gzip.open(gzpath, 'wb') as dst:
+        shutil.copyfileobj(src, dst, LOG_CHUNK_SIZE)
+    return gzpath
+
+
 def do_request(url, test_result, metadata, files=None, metrics=None):
-    files = files or ()
+    """Submit a test run to Squad
+
+    files are the paths of the attachments, open files are still accepted
+    and sent from their name.  Attachments are gzipped when
+    SSS_GZIP_ATTACHMENTS is set, and when SSS_ATTACHMENT_INDEX is set the
+    ones already uploaded to the same build, from any arch, are not sent
+    again, the duplicated_attachments metadata points to the first upload
+    instead.
+    """
+    files = [getattr(file, 'name', file) for file in files or ()]
     metrics = metrics or {}
     AUTH_TOKEN = get_varenv_or_raise('AUTH_TOKEN', MissingAUTH_TOKEN)
     SQUAD_HOST = get_varenv_or_raise('SQUAD_HOST', MissingSQUAD_HOST)
-    headers = {
-        "Auth-Token": AUTH_TOKEN,
-    }
-    data = {
-        'tests': json.dumps(test_result),
-        'metadata': json.dumps(metadata),
-        'metrics': json.dumps(metrics),
-    }
+    index = get_attachment_index()
+    uploads = {}
+    duplicated = {}
+    if index is not None:
+        # The url ends with the arch, job_id/name references are unique in
+        # the project so the arches of a build share their uploads
+        build_url = url.rsplit('/', 1)[0]
+        unique_files = []
+        for filepath in files:
+            name = os.path.basename(filepath)
+            key = 'attachment-{}-{}'.format(build_url, _sha256_file(filepath))
+            reference = index.get(key) or uploads.get(key)
+            if reference:
+                METRICS.count('attachment_index_hits')
+                duplicated[name] = reference
+            else:
+                METRICS.count('attachment_index_misses')
+                uploads[key] = '{}/{}'.format(metadata.get('job_id'), name)
+                unique_files.append(filepath)
+        files = unique_files
+    if duplicated:
+        metadata = dict(metadata, duplicated_attachments=duplicated)
+    compressed = []
+    if _gzip_attachments():
+        compressed = files = [_gzip_file(filepath) for filepath in files]
+    data = [
+        ('tests', json.dumps(test_result)),
+        ('metadata', json.dumps(metadata)),
+        ('metrics', json.dumps(metrics)),
+    ]
     attachments = []
     for file in files:
         attachments.append(('attachment', file))
+    body = MultipartBody(data, attachments)
+    headers = {
+        "Auth-Token": AUTH_TOKEN,
+        "Content-Type": body.content_type,
+    }
     full_url = '{SQUAD_HOST}/{url}'.format(SQUAD_HOST=SQUAD_HOST, url=url)
     logging.debug('Posting the following payload\ndata:\t%r\nfiles:\t%r',
                   data, attachments)
-    response = requests.post(full_url, headers=headers, data=data, files=attachments)
-    if 'There is already a test run with' in response.content:
-        logging.warning(response.content)
+    size = len(body)
+    start = time.time()
+    try:
+        response = get_http_client().post(full_url, headers=headers,
+                                          data=body)
+    finally:
+        for filepath in compressed:
+            os.remove(filepath)
+    METRICS.add('squad_post', time.time() - start, size)
+    if 'There is already a test run with' in response.text:
+        logging.warning(response.text)
         return
     response.raise_for_status()
+    for key, reference in uploads.items():
+        index.set(key, reference)
 
 
 def _is_field_required(field, expected_key):
@@ -139,91 +794,486 @@ def read_skt_rc_state(skt_rc_path):
     return ini_parser.as_dict()['state']
 
 
-def post_merge_info(project, arch, source_id, state, skt_rc_path, metadata):
-    """tightly coupled to skt"""
+def parse_skt_rc(skt_rc):
+    """Get the skt state section as dict from the content of a skt rc"""
+    ini_parser = IniParser()
+    if hasattr(ini_parser, 'read_string'):
+        ini_parser.read_string(skt_rc)
+    else:
+        ini_parser.readfp(io.StringIO(skt_rc))
+    return ini_parser.as_dict()['state']
+
+
+def _rc_state(skt_rc):
+    """Return the skt state of an already parsed state or a skt rc content"""
+    if isinstance(skt_rc, dict):
+        return skt_rc
+    return parse_skt_rc(skt_rc)
+
+
+def post_merge_data(project, arch, source_id, state, skt_rc, metadata,
+                    submit=None):
+    """Like post_merge_info, skt_rc is a parsed state or a skt rc content"""
     # group name KERNELCI hardcoded for now
     url = 'api/submit/KERNELCI/{project}/{source_id}/{arch}'.format(**locals())
     check_missing_fields = True if state.lower() == 'skip' else False
-    data = read_skt_rc_state(skt_rc_path)
+    data = _rc_state(skt_rc)
     metadata.update(get_merge_metadata(data, check_missing_fields))
     test_result = {'/merge/': state}
-    do_request(url, test_result, metadata)
+    (submit or do_request)(url, test_result, metadata)
 
 
-def post_build_info(project, arch, source_id, state, skt_rc_path, metadata):
+def post_merge_info(project, arch, source_id, state, skt_rc_path, metadata):
     """tightly coupled to skt"""
+    post_merge_data(project, arch, source_id, state,
+                    read_skt_rc_state(skt_rc_path), metadata)
+
+
+def post_build_data(project, arch, source_id, state, skt_rc, metadata,
+                    submit=None):
+    """Like post_build_info, skt_rc is a parsed state or a skt rc content"""
     url = 'api/submit/KERNELCI/{project}/{source_id}/{arch}'.format(**locals())
-    data = read_skt_rc_state(skt_rc_path)
+    data = _rc_state(skt_rc)
     metadata.update(get_merge_metadata(data, False))
     metadata.update(get_build_metadata(data, arch, True))
     test_result = {'/build/': state}
-    do_request(url, test_result, metadata)
+    (submit or do_request)(url, test_result, metadata)
 
 
-def _fetch_log(name, url, tmpdir):
+def post_build_info(project, arch, source_id, state, skt_rc_path, metadata):
+    """tightly coupled to skt"""
+    post_build_data(project, arch, source_id, state,
+                    read_skt_rc_state(skt_rc_path), metadata)
+
+
+LOG_CHUNK_SIZE = 64 * 1024
+LOG_TRUNCATED_MARKER = b'\n[sss: log truncated, it was bigger than %d bytes]\n'
+
+
+def _log_max_size():
+    """Size cap of the logs downloaded, 0 means no cap"""
+    return int(os.environ.get('SSS_LOG_MAX_SIZE', 0))
+
+
+def _log_workers():
+    return int(os.environ.get('SSS_LOG_WORKERS', 4))
+
+
+def _fetch_log(name, url, tmpdir, max_size=None):
+    """Stream the log to disk, keeping only its first max_size bytes"""
+    if max_size is None:
+        max_size = _log_max_size()
     filepath = os.path.join(tmpdir, name)
-    with open(filepath, 'wb') as fh:
-        response = requests.get(url)
-        fh.write(response.content)
+    start = time.time()
+    response = get_http_client().get(url, stream=True)
+    try:
+        with open(filepath, 'wb') as fh:
+            size = 0
+            for chunk in response.iter_content(LOG_CHUNK_SIZE):
+                if max_size and size + len(chunk) > max_size:
+                    fh.write(chunk[:max_size - size])
+                    fh.write(LOG_TRUNCATED_MARKER % max_size)
+                    logging.warning('%s truncated to %d bytes', url, max_size)
+                    size = max_size
+                    break
+                fh.write(chunk)
+                size += len(chunk)
+    finally:
+        response.close()
+    METRICS.add('log_download', time.time() - start, size)
     return filepath
 
 
-def _get_log_files(task_logs, beaker_host, tmpdir):
-    files = []
-    for log in task_logs:
-        url = '{}/{}'.format(beaker_host, log['href'])
-        filepath = _fetch_log(log['path'], url, tmpdir)
-        files.append(open(filepath, 'rb'))
-    return files
-
-
-def get_log_by_task(task, task_name):
-    if 'logs' not in task:
-        return {}
-    test_name = task['@path']
-    if task_name not in task['@path']:
-        test_name = '{}/{}'.format(task_name, task['@path'])
-    result = {
-        'name': test_name,
-        'result': task['@result'],
-        'id': task['@id'],
-        'url_log': task['logs']['log']['@href'],
-    }
+def _fetch_logs(logs, tmpdir):
+    """Download the (name, url) logs concurrently, return their paths"""
+    workers = min(_log_workers(), len(logs))
+    if workers <= 1:
+        return [_fetch_log(name, url, tmpdir) for name, url in logs]
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(lambda log: _fetch_log(log[0], log[1], tmpdir), logs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class ResponseCache(object):
+    """On-disk cache of HTTP responses, size bounded with LRU eviction
+
+    Each entry is a body file plus a .meta JSON file holding its expiry, a
+    None expiry keeps it until it is evicted, and the ETag and Last-Modified
+    of its response.  Expired entries having one of them are kept to
+    revalidate them with a conditional request.  The mtime of the body is
+    its last use, the least recently used bodies are evicted first once the
+    cache is bigger than max_size bytes.  Its size is counted as bodies are
+    put, the directory is only scanned by the first put and once the cache
+    looks full, the bodies put by other processes are counted then.
+    """
+    META_SUFFIX = '.meta'
+    TMP_PREFIX = '.tmp-'
+
+    def __init__(self, directory, max_size, ttl=300):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Bytes of the bodies cached, None until the directory is scanned
+        self._size = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _read_meta(self, key):
+        try:
+            with open(self._path(key) + self.META_SUFFIX) as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_meta(self, key, meta):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=self.TMP_PREFIX)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(meta, fh)
+        os.rename(tmp, self._path(key) + self.META_SUFFIX)
+
+    def _remove(self, key):
+        for path in (self._path(key), self._path(key) + self.META_SUFFIX):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key):
+        """Return the path of the fresh body cached for key, or None"""
+        with self._lock:
+            meta = self._read_meta(key)
+            if meta is None:
+                return None
+            if meta['expires'] is not None and meta['expires'] < time.time():
+                if not meta.get('validators'):
+                    self._remove(key)
+                return None
+            try:
+                os.utime(self._path(key), None)
+            except OSError:
+                return None
+            return self._path(key)
+
+    def validators(self, key):
+        """Return the path and validators of the body cached for key
+
+        The body can be expired, (None, None) is returned without validators.
+        """
+        with self._lock:
+            meta = self._read_meta(key)
+            if not meta or not meta.get('validators') or not os.path.exists(
+                    self._path(key)):
+                return None, None
+            return self._path(key), meta['validators']
+
+    def refresh(self, key, ttl=None):
+        """Expire key ttl seconds from now, once it is known not modified"""
+        with self._lock:
+            meta = self._read_meta(key)
+            if meta is None:
+                return
+            meta['expires'] = None if ttl is None else time.time() + ttl
+            self._write_meta(key, meta)
+            try:
+                os.utime(self._path(key), None)
+            except OSError:
+                pass
+
+    def put(self, key, chunks, ttl=None, validators=None):
+        """Store the body made of chunks and return its path
+
+        It expires after ttl seconds, or never when ttl is None.  validators
+        are the ones of the response, see response_validators.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=self.TMP_PREFIX)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            os.remove(tmp)
+            raise
+        with self._lock:
+            try:
+                size -= os.path.getsize(self._path(key))
+            except OSError:
+                pass
+            os.rename(tmp, self._path(key))
+            self._write_meta(key, {
+                'expires': None if ttl is None else time.time() + ttl,
+                'validators': validators or None,
+            })
+            if self._size is None or self._size + size > self.max_size:
+                self._size = self._evict(key)
+            else:
+                self._size += size
+        return self._path(key)
+
+    def keep(self, key):
+        """Never expire key, e.g. once it is known to be immutable"""
+        with self._lock:
+            meta = self._read_meta(key)
+            if meta is not None:
+                meta['expires'] = None
+                self._write_meta(key, meta)
+
+    def _evict(self, keep):
+        """Evict the least recently used bodies, but keep, just written
+
+        Return the size of the bodies left.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(self.META_SUFFIX) or name.startswith(
+                    self.TMP_PREFIX):
+                continue
+            try:
+                stat = os.stat(self._path(name))
+            except OSError:
+                continue
+            total += stat.st_size
+            if name != keep:
+                entries.append((stat.st_mtime, stat.st_size, name))
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(name)
+            total -= size
+        return total
+
+
+def response_validators(response):
+    """Return the ETag and Last-Modified of response, None without them"""
+    validators = dict((name, response.headers[name])
+                      for name in ('ETag', 'Last-Modified')
+                      if response.headers.get(name))
+    return validators or None
+
+
+def conditional_headers(validators):
+    """Return the headers revalidating a response with these validators"""
+    headers = {}
+    if validators and validators.get('ETag'):
+        headers['If-None-Match'] = validators['ETag']
+    if validators and validators.get('Last-Modified'):
+        headers['If-Modified-Since'] = validators['Last-Modified']
+    return headers
+
+
+_response_caches = {}
+_response_caches_lock = threading.Lock()
+
+
+def _get_response_cache(name, directory, size, ttl):
+    if not directory:
+        return None
+    with _response_caches_lock:
+        cache = _response_caches.get(name)
+        if cache is None or cache.directory != directory:
+            cache = _response_caches[name] = ResponseCache(directory, size,
+                                                           ttl)
+        return cache
+
+
+def _user_cache_dir(name):
+    """Return the directory name of the cache of the user"""
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.expanduser(os.path.join('~', '.cache')),
+                        'sss', name)
+
+
+def get_beaker_cache():
+    """Return the cache of the Beaker responses, None if disabled
+
+    It lives into SSS_BEAKER_CACHE_DIR (~/.cache/sss/beaker by default, empty
+    to disable it), SSS_BEAKER_CACHE_SIZE bounds its size in bytes (1GiB by
+    default) and recipes still running expire after SSS_BEAKER_CACHE_TTL
+    seconds (300 by default), they are revalidated then when Beaker gave
+    them an ETag or a Last-Modified.
+    """
+    return _get_response_cache(
+        'beaker',
+        os.environ.get('SSS_BEAKER_CACHE_DIR', _user_cache_dir('beaker')),
+        int(os.environ.get('SSS_BEAKER_CACHE_SIZE', 1024 ** 3)),
+        float(os.environ.get('SSS_BEAKER_CACHE_TTL', 300)),
+    )
+
+
+def get_jenkins_cache():
+    """Return the cache of the Jenkins job metadata, None if disabled
+
+    It lives into SSS_JENKINS_CACHE_DIR (~/.cache/sss/jenkins by default,
+    empty to disable it) and SSS_JENKINS_CACHE_SIZE bounds its size in bytes
+    (256MiB by default).  Its responses are revalidated on every use, only
+    the ones having an ETag or a Last-Modified are kept.
+    """
+    return _get_response_cache(
+        'jenkins',
+        os.environ.get('SSS_JENKINS_CACHE_DIR', _user_cache_dir('jenkins')),
+        int(os.environ.get('SSS_JENKINS_CACHE_SIZE', 256 * 1024 ** 2)),
+        0,
+    )
+
+
+def _beaker_cache_key(beaker_host, name):
+    """Return the cache key of name, apart for each Beaker server"""
+    host = urlsplit(beaker_host).netloc or beaker_host
+    return '{}-{}'.format(host.replace('/', '_'), name)
+
+
+def _is_recipe_finished(status):
+    return status in BEAKER_FINISHED_STATUS
+
+
+def get_recipeset(beaker_host, recipeset_id):
+    """Return the recipeset JSON, cached for good once every recipe finished"""
+    cache = get_beaker_cache()
+    key = _beaker_cache_key(beaker_host,
+                            'recipeset-{}.json'.format(recipeset_id))
+    path = cache and cache.get(key)
+    if path:
+        METRICS.count('beaker_cache_hits')
+        with open(path) as fh:
+            return json.load(fh)
+    stale = validators = None
+    if cache:
+        METRICS.count('beaker_cache_misses')
+        stale, validators = cache.validators(key)
+    url = '{beaker_host}/recipesets/{recipeset_id}'.format(**locals())
+    start = time.time()
+    response = get_http_client().get(url,
+                                     headers=conditional_headers(validators))
+    if response.status_code == 304 and stale:
+        with open(stale) as fh:
+            result = json.load(fh)
+    else:
+        response.raise_for_status()
+        result = response.json()
+    METRICS.add('beaker_recipeset', time.time() - start,
+                len(response.content))
+    if cache:
+        finished = all(_is_recipe_finished(recipe.get('status'))
+                       for recipe in result['machine_recipes'])
+        ttl = None if finished else cache.ttl
+        if response.status_code == 304 and stale:
+            cache.refresh(key, ttl)
+        else:
+            cache.put(key, [response.content], ttl,
+                      response_validators(response))
     return result
 
 
-def get_test_results(beaker_host, recipe_id):
-    response = requests.get('{beaker_host}/recipes/{recipe_id}.xml'.format(**locals()))
-    result = xmltodict.parse(response.content)
-    tests = []
+def _recipe_status(fh):
+    for event, elem in ElementTree.iterparse(fh, events=('start',)):
+        if elem.tag == 'recipe':
+            return elem.get('status')
+    return None
+
+
+def _iter_recipe_tests(fh):
+    """Yield the results logged by the tasks after kpkginstall of a recipe
+
+    The XML is parsed as it is read, every task is dropped as soon as it is
+    closed and the ones before /distribution/kpkginstall are not even kept
+    until then.
+    """
     after_distribution_kpkginstall = False
-    for task in result['job']['recipeSet']['recipe']['task']:
-        if not after_distribution_kpkginstall:
-            if task['@name'] == '/distribution/kpkginstall':
-                after_distribution_kpkginstall = True
+    skipping = False
+    path = []
+    for event, elem in ElementTree.iterparse(fh, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'task' and path == RECIPE_PATH:
+                skipping = not after_distribution_kpkginstall
+                if elem.get('name') == '/distribution/kpkginstall':
+                    after_distribution_kpkginstall = True
+            path.append(elem.tag)
             continue
-        task_name, subtasks = task['@name'], task['results']
-        if type(subtasks['result']) == list:
-            for subtask in subtasks['result']:
-                test = get_log_by_task(subtask, task_name)
-                if test:
-                    tests.append(test)
-        else:
-            test = get_log_by_task(subtasks['result'], task_name)
-            if test:
-                tests.append(test)
-    return tests
+        path.pop()
+        if elem.tag != 'task' or path != RECIPE_PATH:
+            if skipping:
+                elem.clear()
+            continue
+        if not skipping:
+            task_name = elem.get('name')
+            results = elem.find('results')
+            for subtask in (results if results is not None else ()):
+                log = subtask.find('logs/log')
+                if subtask.tag != 'result' or log is None:
+                    continue
+                test_name = subtask.get('path')
+                if task_name not in test_name:
+                    test_name = '{}/{}'.format(task_name, test_name)
+                yield {
+                    'name': test_name,
+                    'result': subtask.get('result'),
+                    'id': subtask.get('id'),
+                    'url_log': log.get('href'),
+                }
+        skipping = False
+        elem.clear()
+
+
+def iter_test_results(beaker_host, recipe_id):
+    """Stream the recipe XML and yield its test results as parsed"""
+    cache = get_beaker_cache()
+    key = _beaker_cache_key(beaker_host, 'recipe-{}.xml'.format(recipe_id))
+    path = cache and cache.get(key)
+    if cache:
+        METRICS.count('beaker_cache_hits' if path else 'beaker_cache_misses')
+    if not path:
+        url = '{beaker_host}/recipes/{recipe_id}.xml'.format(**locals())
+        stale, validators = cache.validators(key) if cache else (None, None)
+        response = get_http_client().get(
+            url, stream=True, headers=conditional_headers(validators))
+        try:
+            if response.status_code == 304 and stale:
+                cache.refresh(key, cache.ttl)
+                path = stale
+            else:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                if not cache:
+                    for test in _iter_recipe_tests(response.raw):
+                        yield test
+                    return
+                path = cache.put(key, response.iter_content(LOG_CHUNK_SIZE),
+                                 cache.ttl, response_validators(response))
+        finally:
+            response.close()
+        with open(path, 'rb') as fh:
+            if _is_recipe_finished(_recipe_status(fh)):
+                cache.keep(key)
+    with open(path, 'rb') as fh:
+        for test in _iter_recipe_tests(fh):
+            yield test
+
+
+def get_test_results(beaker_host, recipe_id):
+    with METRICS.timer('beaker_recipe'):
+        return list(iter_test_results(beaker_host, recipe_id))
 
 
-def post_task(beaker_host, url_squad, task, metadata, beaker_result):
+def post_task(beaker_host, url_squad, task, metadata, beaker_result,
+              submit=None):
     task_name = task['name']
     test_result = {}
-    tmpdir = tempfile.mkdtemp()
-    files = _get_log_files(task['logs'], beaker_host, tmpdir)
+    logs = [(log['path'], '{}/{}'.format(beaker_host, log['href']))
+            for log in task['logs']]
     # job_id must be unique, so it's better using beaker ids
     metadata['job_id'] = '{}-{}'.format(task['id'],
                                         task_name.strip('/').replace('/', '-'))
     if task['status'] == 'Completed':
+        import dateutil.parser
         finish_time = dateutil.parser.parse(task['finish_time'])
         start_time = dateutil.parser.parse(task['start_time'])
         duration = finish_time - start_time
@@ -238,29 +1288,62 @@ def post_task(beaker_host, url_squad, task, metadata, beaker_result):
         subtask_name = test['name'].split(task_name)[1]
         subtask_name = '-'.join(subtask_name.lstrip('/').split('/'))
         subtask_name = subtask_name or os.path.basename(test['name'])
-        filepath = _fetch_log(subtask_name + '.log', test['url_log'], tmpdir)
-        files.append(open(filepath, 'rb'))
+        logs.append((subtask_name + '.log', test['url_log']))
         subtask_fullname = task_name + '/' + subtask_name
         test_result[subtask_fullname] = test['result']
-    do_request(url_squad, test_result, metadata, files, metrics)
-    shutil.rmtree(tmpdir)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = _fetch_logs(logs, tmpdir)
+        (submit or do_request)(url_squad, test_result, metadata, files,
+                               metrics)
+    finally:
+        shutil.rmtree(tmpdir)
 
 
-def post_test_info(project, arch, source_id, skt_rc_path, metadata):
-    beaker_host = 'https://beaker.engineering.redhat.com'
-    data = read_skt_rc_state(skt_rc_path)
+def _task_workers():
+    return int(os.environ.get('SSS_TASK_WORKERS', 4))
+
+
+def post_test_data(project, arch, source_id, skt_rc, metadata, submit=None):
+    """Like post_test_info, skt_rc is a parsed state or a skt rc content
+
+    Every machine recipe of the recipeset is reported, their results are
+    fetched and their tasks posted by up to SSS_TASK_WORKERS threads.
+    """
+    beaker_host = os.environ.get('BEAKER_HOST', DEFAULT_BEAKER_HOST)
+    data = _rc_state(skt_rc)
     recipeset = data['recipesetid_0'].split(':')[1]
-    url = '{beaker_host}/recipesets/{recipeset}'.format(**locals())
-    response = requests.get(url)
-    result = response.json()
+    result = get_recipeset(beaker_host, recipeset)
     url_squad = 'api/submit/KERNELCI/{project}/{source_id}/{arch}'.format(**locals())
     metadata.update(get_merge_metadata(data, False))
     metadata.update(get_build_metadata(data, arch, True))
-    recipe_id = result['machine_recipes'][0]['recipe_id']
-    beaker_result = get_test_results(beaker_host, recipe_id)
-    for task in result['machine_recipes'][0]['tasks']:
-        if task['name'].startswith('/kernel'):
-            post_task(beaker_host, url_squad, task, metadata, beaker_result)
+    recipes = result['machine_recipes']
+    pool = ThreadPool(_task_workers()) if _task_workers() > 1 else None
+    try:
+        beaker_results = _map(
+            pool,
+            lambda recipe: get_test_results(beaker_host, recipe['recipe_id']),
+            recipes
+        )
+        tasks = []
+        for recipe, beaker_result in zip(recipes, beaker_results):
+            for task in recipe['tasks']:
+                if task['name'].startswith('/kernel'):
+                    tasks.append((task, beaker_result))
+        # post_task sets the job_id of the task into its own metadata copy
+        _map(pool,
+             lambda task: post_task(beaker_host, url_squad, task[0],
+                                    dict(metadata), task[1], submit),
+             tasks)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def post_test_info(project, arch, source_id, skt_rc_path, metadata):
+    post_test_data(project, arch, source_id, read_skt_rc_state(skt_rc_path),
+                   metadata)
 
 
 def get_sections(console_text):
@@ -278,38 +1361,126 @@ def get_sections(console_text):
     return sections
 
 
-def parse_section(section):
-    result = []
-    payload = False
-    content = []
-    d = {}
-    for line in section:
-        if line.strip() in ['aarch64:', 'ppc64le:', 'x86_64:', 'ppc64:']:
-           d['arch'] = line.strip(':')
-           payload = True
-           continue
-        if payload and line.startswith('[Pipeline]'):
-            payload = False
+class SectionParser(object):
+    """Incremental parse_section, records are returned as soon as closed"""
+    def __init__(self, arches=DEFAULT_ARCHES):
+        self.arches = ['{}:'.format(arch) for arch in arches]
+        self.payload = False
+        self.content = []
+        self.d = {}
+
+    def feed(self, line):
+        """Return the record closed by line, if any"""
+        if line.strip() in self.arches:
+            self.d['arch'] = line.strip(':')
+            self.payload = True
+            return None
+        if self.payload and line.startswith('[Pipeline]'):
+            self.payload = False
+            d, content = self.d, self.content
+            self.d = {}
+            self.content = []
             if d and len(content) > 1:
                 d['skt_rc'] = '\n'.join(content)
-                result.append(d)
-            d = {}
-            content = []
-            continue
-        if payload:
+                return d
+            return None
+        if self.payload:
             if 'configuration' in line:
-                content = ['',]
-                continue
-            if content:
-                content.append(line.strip())
+                self.content = ['',]
+                return None
+            if self.content:
+                self.content.append(line.strip())
             else:
                 line_split = line.split(':')
-                d[line_split[0].strip()] = line_split[1].strip()
+                self.d[line_split[0].strip()] = line_split[1].strip()
+        return None
+
+    def state(self):
+        return {'payload': self.payload, 'content': self.content,
+                'd': self.d}
+
+    def restore(self, state):
+        self.payload = state['payload']
+        self.content = state['content']
+        self.d = state['d']
+
+
+def parse_section(section, arches=DEFAULT_ARCHES):
+    parser = SectionParser(arches)
+    result = []
+    for line in section:
+        d = parser.feed(line)
+        if d is not None:
+            result.append(d)
     return result
 
 
-def _build_source_id(skt_rc_path):
-    skt_rc = read_skt_rc_state(skt_rc_path)
+class ConsoleParser(object):
+    """Single pass parser of the console of a skt pipeline
+
+    Same output as get_sections plus parse_section, but the lines are fed one
+    at a time, e.g. straight from a streamed response, and only the record
+    being parsed is kept in memory.
+    """
+    def __init__(self, arches=DEFAULT_ARCHES):
+        self.arches = arches
+        # Names of the sections with some content, in order of appearance
+        self.sections = []
+        self._parsers = {}
+        self._name = None
+        # Last bytes read by read_progressive_console, a line without its
+        # newline yet
+        self.partial = b''
+
+    def feed(self, line):
+        """Return the (section name, record) closed by line, if any"""
+        if line.startswith('BUILD STATE'):
+            self._name = ' '.join(line.split()[3:])
+            return None
+        if line.startswith('[Pipeline] stage'):
+            self._name = None
+        if self._name is None:
+            return None
+        if self._name not in self._parsers:
+            self.sections.append(self._name)
+            self._parsers[self._name] = SectionParser(self.arches)
+        d = self._parsers[self._name].feed(line)
+        if d is None:
+            return None
+        return self._name, d
+
+    def state(self):
+        """Return what is needed to resume parsing, as plain JSON data"""
+        return {
+            'sections': self.sections,
+            'name': self._name,
+            'parsers': dict((name, parser.state())
+                            for name, parser in self._parsers.items()),
+            # latin-1 maps each byte to a character, and back
+            'partial': self.partial.decode('latin-1'),
+        }
+
+    @classmethod
+    def from_state(cls, state, arches=DEFAULT_ARCHES):
+        parser = cls(arches)
+        parser.sections = state['sections']
+        parser._name = state['name']
+        parser.partial = state.get('partial', '').encode('latin-1')
+        for name, parser_state in state['parsers'].items():
+            parser._parsers[name] = SectionParser(arches)
+            parser._parsers[name].restore(parser_state)
+        return parser
+
+    def parse(self, lines):
+        """Yield the (section name, record) pairs as soon as they close"""
+        for line in lines:
+            closed = self.feed(line)
+            if closed is not None:
+                yield closed
+
+
+def _source_id(skt_rc):
+    skt_rc = _rc_state(skt_rc)
     source_id = skt_rc['basehead'][:8]
     for k, v in skt_rc.items():
         if k.startswith('patchwork'):
@@ -318,77 +1489,920 @@ def _build_source_id(skt_rc_path):
     return source_id
 
 
+def _build_source_id(skt_rc_path):
+    return _source_id(read_skt_rc_state(skt_rc_path))
+
+
+class StateStore(object):
+    """Interface of the stores keeping track of the steps already posted
+
+    Stores are shared by the threads processing builds and arches, so every
+    implementation has to be thread safe.
+    """
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value=True):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def acquire(self, key, owner, ttl, stale=None):
+        """Take the lease key for ttl seconds, unless someone else holds it
+
+        The lease of an owner for which stale(owner) is true is taken over
+        before it expires.  Stores shared by several processes must
+        implement it, the others have a single owner.
+        """
+        return True
+
+    def release(self, key, owner):
+        pass
+
+    def commit(self):
+        """Make every pending write durable"""
+
+    def close(self):
+        self.commit()
+
+
+class SqliteStateStore(StateStore):
+    """Default store, one indexed row per key into a SQLite database
+
+    Writes are committed every batch_size calls to set, so a crash loses at
+    most the last batch_size steps, which Squad deduplicates by job_id anyway.
+    """
+    def __init__(self, path, batch_size=1):
+        self.path = path
+        self.batch_size = batch_size
+        self._pending = 0
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=60,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS state '
+                           '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._conn.commit()
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM state WHERE key = ?',
+                                     (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value=True):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                               (key, json.dumps(value)))
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM state WHERE key = ?', (key,))
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self.commit()
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self._conn.close()
+
+    def acquire(self, key, owner, ttl, stale=None):
+        with self._lock:
+            self.commit()
+            now = time.time()
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT value FROM state WHERE key = ?', (key,)
+                ).fetchone()
+                lease = json.loads(row[0]) if row else None
+                if (lease and lease['owner'] != owner and
+                        lease['expires'] > now and
+                        not (stale and stale(lease['owner']))):
+                    self._conn.rollback()
+                    return False
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO state VALUES (?, ?)',
+                    (key, json.dumps({'owner': owner, 'expires': now + ttl}))
+                )
+                self._conn.commit()
+                return True
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def release(self, key, owner):
+        with self._lock:
+            lease = self.get(key)
+            if lease and lease['owner'] == owner:
+                self._conn.execute('DELETE FROM state WHERE key = ?', (key,))
+            self.commit()
+
+    def is_empty(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT 1 FROM state LIMIT 1').fetchone() is None
+
+    def migrate_from_pickledb(self, path):
+        """Import every key of a pickledb file, return how many were read"""
+        with open(path) as fh:
+            data = json.load(fh)
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO state VALUES (?, ?)',
+                ((k, json.dumps(v)) for k, v in data.items())
+            )
+            self.commit()
+        return len(data)
+
+
+class PickleDBStateStore(StateStore):
+    """Legacy store, the whole pickledb file is rewritten on every commit"""
+    def __init__(self, path, batch_size=1):
+        import pickledb
+        self.batch_size = batch_size
+        self._pending = 0
+        self._lock = threading.RLock()
+        self._db = pickledb.load(path, False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._db.get(key)
+        return default if value is False else value
+
+    def set(self, key, value=True):
+        with self._lock:
+            self._db.set(key, value)
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._db.rem(key)
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self.commit()
+
+    def commit(self):
+        with self._lock:
+            self._db.dump()
+            self._pending = 0
+
+
+STATE_STORES = {
+    'sqlite': SqliteStateStore,
+    'pickledb': PickleDBStateStore,
+}
+
+
+def open_state_store(backend, path, batch_size=1, migrate_from=None):
+    """Return a StateStore, importing migrate_from into new SQLite stores"""
+    db = STATE_STORES[backend](path, batch_size)
+    if (migrate_from and isinstance(db, SqliteStateStore) and
+            os.path.exists(migrate_from) and db.is_empty()):
+        count = db.migrate_from_pickledb(migrate_from)
+        logging.info('Migrated %d keys from %s to %s', count, migrate_from,
+                     path)
+    return db
+
+
 def sss_save_state(db, job_id):
     db.set(job_id, True)
-    db.dump()
-
 
-def process_build(job_name, build, build_info, sections, db):
-    status_map = {
-        'Created': 'Patching fail',
-        'Merged': 'Building fail',
-        'Built': 'Testing fail weirdly',
-        'Tested': 'Testing fail',
-        'Passed': 'OK',
-    }
-    merge_fail_status = {
-        'Created': 'fail',
-    }
-    build_fail_status = {
-        'Created': 'fail',
-        'Merged': 'fail',
-        'Built': 'fail',
-    }
-    for data_parsed in parse_section(sections['TESTING']):
-        logging.info(
-            'Parsing %s with status %s for arch %s',
-            build['url'],
-            status_map[data_parsed['status']],
-            data_parsed['arch']
-        )
-        with tempfile.NamedTemporaryFile() as fh:
-            fh.write(data_parsed['skt_rc'].encode('utf-8'))
-            fh.flush()
-
-            source_id = _build_source_id(fh.name)
-            build_date = datetime.fromtimestamp(build_info['timestamp']/1000)
-            metadata = {
-                'build_url': build_info['url'],
-                'datetime': build_date.isoformat(),
-            }
 
-            metadata['job_id'] = '{}-{}-{}'.format(build_info['id'],
-                                                   data_parsed['arch'],
-                                                   'merge')
-            merge_status = merge_fail_status.get(data_parsed['status'], 'pass')
-            if not db.get(metadata['job_id']):
-                logging.info('Post step %s', metadata['job_id'])
-                post_merge_info(job_name, data_parsed['arch'], source_id,
-                                merge_status, fh.name, metadata)
-            sss_save_state(db, metadata['job_id'])
-            if merge_status == 'fail':
+def _map(pool, func, iterable):
+    """Call func on each item, using the pool if there is one"""
+    if pool is None:
+        return [func(item) for item in iterable]
+    return pool.map(func, iterable)
+
+
+class CoalescedSubmission(object):
+    """Buffer the test runs of a build arch and submit them as a single one
+
+    It is called like do_request, from several threads too.  Tests, metrics
+    and metadata are merged, the attachments are moved into a directory of
+    its own, since callers remove theirs once submitted, and flush submits
+    everything under job_id, listing the job_id of each step into
+    coalesced_job_ids.  A step with a test or a metric already buffered,
+    like the same task run by two hosts of a recipeset, is submitted on its
+    own instead, so that none of the results is overwritten.
+    """
+    def __init__(self, job_id, submit=None):
+        self.job_id = job_id
+        self.submit = submit
+        self.url = None
+        self.tests = {}
+        self.metrics = {}
+        self.metadata = {}
+        self.files = []
+        self.job_ids = []
+        self.tmpdir = tempfile.mkdtemp()
+        self._lock = threading.Lock()
+
+    def __call__(self, url, test_result, metadata, files=None, metrics=None):
+        with self._lock:
+            if self._add(url, test_result, metadata, files, metrics):
+                return
+        logging.info('%s has results already coalesced, submitted apart',
+                     metadata['job_id'])
+        (self.submit or do_request)(url, test_result, metadata, files,
+                                    metrics)
+
+    def _add(self, url, test_result, metadata, files, metrics):
+        if self.url not in (None, url):
+            raise ValueError('Cannot coalesce {} with {}'.format(url,
+                                                                 self.url))
+        if (set(test_result) & set(self.tests) or
+                set(metrics or ()) & set(self.metrics)):
+            return False
+        self.url = url
+        self.tests.update(test_result)
+        self.metrics.update(metrics or {})
+        self.metadata.update(metadata)
+        self.job_ids.append(metadata['job_id'])
+        for file in files or ():
+            filepath = getattr(file, 'name', file)
+            name = os.path.basename(filepath)
+            if os.path.exists(os.path.join(self.tmpdir, name)):
+                name = '{}-{}'.format(metadata['job_id'], name)
+            self.files.append(os.path.join(self.tmpdir, name))
+            shutil.move(filepath, self.files[-1])
+        return True
+
+    def flush(self):
+        with self._lock:
+            if self.url is None:
+                return
+            metadata = dict(self.metadata, job_id=self.job_id,
+                            coalesced_job_ids=self.job_ids)
+            (self.submit or do_request)(self.url, self.tests, metadata,
+                                        self.files, self.metrics)
+
+    def close(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def _is_transient(error):
+    """Whether a failed submission may succeed when retried
+
+    Authentication and not found errors are transient too, they come from a
+    wrong AUTH_TOKEN or SQUAD_URL, which get fixed.
+    """
+    if isinstance(error, MissingField):
+        return False
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status in (401, 403, 404, 408, 429)
+    return True
+
+
+class Outbox(object):
+    """Durable queue of the Squad submissions, drained apart from collection
+
+    put is called like do_request, it moves the attachments into the spool
+    directory and records the submission into a SQLite database, so it
+    survives restarts.  drain submits what is due, transient failures are
+    retried later with an exponential backoff.  Submissions rejected for good,
+    or failing max_attempts times, are set aside as dead, with their spool,
+    and are not counted by len anymore, until retry_dead queues them again.
+    """
+    def __init__(self, path, backoff=30, max_backoff=3600, max_attempts=10):
+        self.path = path
+        self.spool = path + '.spool'
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.spool):
+            os.makedirs(self.spool)
+        self._conn = sqlite3.connect(path, timeout=60,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                           'url TEXT NOT NULL,'
+                           'payload TEXT NOT NULL,'
+                           'attempts INTEGER NOT NULL DEFAULT 0,'
+                           'next_attempt REAL NOT NULL DEFAULT 0,'
+                           'last_error TEXT,'
+                           'dead INTEGER NOT NULL DEFAULT 0)')
+        columns = [row[1] for row in
+                   self._conn.execute('PRAGMA table_info(outbox)')]
+        if 'dead' not in columns:
+            self._conn.execute('ALTER TABLE outbox ADD COLUMN'
+                               ' dead INTEGER NOT NULL DEFAULT 0')
+        self._conn.commit()
+
+    def put(self, url, test_result, metadata, files=None, metrics=None):
+        spool = tempfile.mkdtemp(dir=self.spool)
+        attachments = []
+        for file in files or ():
+            filepath = getattr(file, 'name', file)
+            attachments.append(os.path.join(spool,
+                                            os.path.basename(filepath)))
+            shutil.move(filepath, attachments[-1])
+        payload = {
+            'tests': test_result,
+            'metadata': metadata,
+            'metrics': metrics or {},
+            'files': attachments,
+            'spool': spool,
+        }
+        with self._lock:
+            self._conn.execute('INSERT INTO outbox (url, payload) '
+                               'VALUES (?, ?)', (url, json.dumps(payload)))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM outbox WHERE NOT dead').fetchone()[0]
+
+    def dead(self):
+        """Return how many submissions were set aside as dead"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM outbox WHERE dead').fetchone()[0]
+
+    def retry_dead(self):
+        """Queue the dead submissions again, return how many there were"""
+        with self._lock:
+            count = self._conn.execute(
+                'UPDATE outbox SET dead = 0, attempts = 0, next_attempt = 0'
+                ' WHERE dead').rowcount
+            self._conn.commit()
+        return count
+
+    def _next(self, after):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT id, url, payload, attempts FROM outbox WHERE id > ?'
+                ' AND NOT dead AND next_attempt <= ? ORDER BY id LIMIT 1',
+                (after, time.time())
+            ).fetchone()
+
+    def drain(self, submit=None, stop=None):
+        """Submit every due submission once, return how many were sent"""
+        sent = 0
+        last_id = 0
+        while stop is None or not stop.is_set():
+            row = self._next(last_id)
+            if row is None:
+                break
+            last_id, url, payload, attempts = row
+            payload = json.loads(payload)
+            try:
+                (submit or do_request)(url, payload['tests'],
+                                       payload['metadata'], payload['files'],
+                                       payload['metrics'])
+            except Exception as e:
+                dead = (not _is_transient(e) or
+                        attempts + 1 >= self.max_attempts)
+                delay = min(self.max_backoff, self.backoff * 2 ** attempts)
+                if dead:
+                    logging.error('Submission %s of %s failed, giving up: %s',
+                                  payload['metadata'].get('job_id'), url, e)
+                else:
+                    logging.warning('Submission %s of %s failed, retrying'
+                                    ' in %ds: %s',
+                                    payload['metadata'].get('job_id'), url,
+                                    delay, e)
+                with self._lock:
+                    self._conn.execute(
+                        'UPDATE outbox SET attempts = ?, next_attempt = ?,'
+                        ' last_error = ?, dead = ? WHERE id = ?',
+                        (attempts + 1, time.time() + delay, str(e), dead,
+                         last_id)
+                    )
+                    self._conn.commit()
                 continue
+            with self._lock:
+                self._conn.execute('DELETE FROM outbox WHERE id = ?',
+                                   (last_id,))
+                self._conn.commit()
+            shutil.rmtree(payload['spool'], ignore_errors=True)
+            sent += 1
+        return sent
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class OutboxSender(threading.Thread):
+    """Drain an outbox in the background every interval seconds"""
+    def __init__(self, outbox, interval=5):
+        super(OutboxSender, self).__init__(name='outbox-sender')
+        self.daemon = True
+        self.outbox = outbox
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.outbox.drain(stop=self._stop_event)
+            except Exception:
+                logging.exception('Draining the outbox failed')
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        """Stop after the submission in flight, then drain what is due"""
+        self._stop_event.set()
+        self.join()
+        self.outbox.drain()
+
+
+def _arch_context(build_info, data_parsed):
+    """Return the skt state, source_id and base metadata of an arch record"""
+    rc_state = parse_skt_rc(data_parsed['skt_rc'])
+    build_date = datetime.fromtimestamp(build_info['timestamp']/1000)
+    metadata = {
+        'build_url': build_info['url'],
+        'datetime': build_date.isoformat(),
+    }
+    return rc_state, _source_id(rc_state), metadata
+
+
+def _post_arch_steps(job_name, build_info, data_parsed, db, save,
+                     submit=None):
+    """Post merge, build and test steps of one arch, in that order"""
+    rc_state, source_id, metadata = _arch_context(build_info, data_parsed)
+
+    metadata['job_id'] = '{}-{}-{}'.format(build_info['id'],
+                                           data_parsed['arch'],
+                                           'merge')
+    merge_status = MERGE_FAIL_STATUS.get(data_parsed['status'], 'pass')
+    if not db.get(metadata['job_id']):
+        logging.info('Post step %s', metadata['job_id'])
+        post_merge_data(job_name, data_parsed['arch'], source_id,
+                        merge_status, rc_state, metadata, submit)
+    save(metadata['job_id'])
+    if merge_status == 'fail':
+        return
 
-            metadata['job_id'] = '{}-{}-{}'.format(build_info['id'],
-                                                   data_parsed['arch'],
-                                                   'build')
-            build_status = build_fail_status.get(data_parsed['status'], 'pass')
-            if not db.get(metadata['job_id']):
-                logging.info('Post step %s', metadata['job_id'])
-                post_build_info(job_name, data_parsed['arch'], source_id,
-                                build_status, fh.name, metadata)
-            sss_save_state(db, metadata['job_id'])
-            if build_status == 'fail':
-                continue
+    metadata['job_id'] = '{}-{}-{}'.format(build_info['id'],
+                                           data_parsed['arch'],
+                                           'build')
+    build_status = BUILD_FAIL_STATUS.get(data_parsed['status'], 'pass')
+    if not db.get(metadata['job_id']):
+        logging.info('Post step %s', metadata['job_id'])
+        post_build_data(job_name, data_parsed['arch'], source_id,
+                        build_status, rc_state, metadata, submit)
+    save(metadata['job_id'])
+    if build_status == 'fail':
+        return
 
-            job_id = '{}-{}-{}'.format(build_info['id'],
-                                       data_parsed['arch'],
-                                       'test')
-            if not db.get(job_id):
-                logging.info('Post step %s', job_id)
-                post_test_info(job_name, data_parsed['arch'], source_id,
-                               fh.name, metadata)
+    job_id = '{}-{}-{}'.format(build_info['id'],
+                               data_parsed['arch'],
+                               'test')
+    if not db.get(job_id):
+        logging.info('Post step %s', job_id)
+        post_test_data(job_name, data_parsed['arch'], source_id,
+                       rc_state, metadata, submit)
+    save(job_id)
+
+
+def post_live_steps(job_name, build_info, data_parsed, db, submit=None):
+    """Post the steps a record of a running build shows as passed
+
+    Only merge and build can be known passed before the build finishes,
+    failures and tests are posted once it is finished.
+    """
+    rc_state, source_id, metadata = _arch_context(build_info, data_parsed)
+    steps = (
+        ('merge', LIVE_MERGED_STATUS, post_merge_data),
+        ('build', LIVE_BUILT_STATUS, post_build_data),
+    )
+    for step, passed_status, post in steps:
+        if data_parsed['status'] not in passed_status:
+            return
+        metadata['job_id'] = '{}-{}-{}'.format(build_info['id'],
+                                               data_parsed['arch'], step)
+        if not db.get(metadata['job_id']):
+            logging.info('Post step %s of running build', metadata['job_id'])
+            post(job_name, data_parsed['arch'], source_id, 'pass', rc_state,
+                 metadata, submit)
+        sss_save_state(db, metadata['job_id'])
+
+
+def process_arch(job_name, build, build_info, data_parsed, db, submit=None,
+                 coalesce=False):
+    """Post merge, build and test steps of one arch, in that order
+
+    With coalesce the steps not posted yet are submitted as a single test
+    run, whose job_id is {build id}-{arch}, and they are only saved once it
+    is submitted.
+    """
+    logging.info(
+        'Parsing %s with status %s for arch %s',
+        build['url'],
+        STATUS_MAP[data_parsed['status']],
+        data_parsed['arch']
+    )
+    if not coalesce:
+        _post_arch_steps(job_name, build_info, data_parsed, db,
+                         lambda job_id: sss_save_state(db, job_id), submit)
+        return
+    submission = CoalescedSubmission(
+        '{}-{}'.format(build_info['id'], data_parsed['arch']), submit)
+    try:
+        job_ids = []
+        _post_arch_steps(job_name, build_info, data_parsed, db,
+                         job_ids.append, submission)
+        submission.flush()
+        for job_id in job_ids:
             sss_save_state(db, job_id)
+    finally:
+        submission.close()
+
+
+def process_records(job_name, build_info, records, db, pool=None,
+                    submit=None, coalesce=False):
+    """Post the steps of every arch record of the TESTING section"""
+    _map(pool,
+         lambda data_parsed: process_arch(job_name, build_info, build_info,
+                                          data_parsed, db, submit, coalesce),
+         records)
+
+
+def process_build(job_name, build, build_info, sections, db, pool=None,
+                  submit=None, coalesce=False):
+    """Post the steps of every arch found into the TESTING section"""
+    _map(pool,
+         lambda data_parsed: process_arch(job_name, build, build_info,
+                                          data_parsed, db, submit, coalesce),
+         parse_section(sections['TESTING']))
+
+
+def jenkins_get(server, url):
+    """Return the body of url, revalidating the one cached if any"""
+    cache = get_jenkins_cache()
+    if cache is None:
+        return server.jenkins_open(requests.Request('GET', url))
+    key = 'jenkins-{}'.format(hashlib.sha256(url.encode('utf-8')).hexdigest())
+    stale, validators = cache.validators(key)
+    response = server.jenkins_request(requests.Request(
+        'GET', url, headers=conditional_headers(validators)
+    ))
+    if response.status_code == 304 and stale:
+        METRICS.count('jenkins_cache_hits')
+        cache.refresh(key, cache.ttl)
+        with io.open(stale, encoding='utf-8') as fh:
+            return fh.read()
+    METRICS.count('jenkins_cache_misses')
+    validators = response_validators(response)
+    if validators:
+        cache.put(key, [response.content], cache.ttl, validators)
+    return response.text
+
+
+def _get_builds(server, job_name, builds_key, fields=BUILD_FIELDS, page=''):
+    folder_url, short_name = server._get_job_folder(job_name)
+    url = server._build_url(JOB_BUILDS_TREE, locals())
+    start = time.time()
+    response = jenkins_get(server, url)
+    METRICS.add('jenkins_api', time.time() - start, len(response))
+    return json.loads(response).get(builds_key) or []
+
+
+def get_builds(server, job_name, fetch_all_builds=False):
+    """Return the metadata of the builds of a job, oldest first"""
+    builds_key = 'allBuilds' if fetch_all_builds else 'builds'
+    return sorted(_get_builds(server, job_name, builds_key),
+                  key=lambda x: x['number'])
+
+
+def get_build_page(server, job_name, start, stop, fields=BUILD_FIELDS):
+    """Return the builds of a job from index start to stop, newest first"""
+    return _get_builds(server, job_name, 'allBuilds', fields,
+                       '{%d,%d}' % (start, stop))
+
+
+def read_console_records(url, arches=DEFAULT_ARCHES):
+    """Stream a consoleText, return its sections and its TESTING records"""
+    parser = ConsoleParser(arches)
+    start = time.time()
+    response = get_http_client().get(url, stream=True)
+    try:
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        lines = TimedIterator(response.iter_lines(decode_unicode=True))
+        records = [d for name, d in parser.parse(lines) if name == 'TESTING']
+    finally:
+        response.close()
+    # Lines are counted without their newline
+    METRICS.add('console_download', lines.seconds, lines.size)
+    METRICS.add('console_parse', time.time() - start - lines.seconds)
+    return parser.sections, records
+
+
+def read_progressive_console(build, parser, start, on_record,
+                             complete=False):
+    """Feed parser the console of build from offset start, return the next
+
+    on_record is called with each (section name, record) closed.  The offsets
+    are the X-Text-Size of Jenkins, which counts the console notes stripped
+    from the text, so not the length of what was read.  Unless complete, a
+    last line without its newline is kept by parser until the next call.
+    """
+    url = '{}/logText/progressiveText'.format(build['url'])
+    began = time.time()
+    response = get_http_client().get(url, params={'start': start},
+                                     stream=True)
+    try:
+        response.raise_for_status()
+        lines = [parser.partial]
+        chunks = TimedIterator(response.iter_content(LOG_CHUNK_SIZE))
+        for chunk in chunks:
+            lines = (lines[-1] + chunk).split(b'\n')
+            for line in lines[:-1]:
+                closed = parser.feed(line.decode('utf-8', 'replace')
+                                     .rstrip('\r'))
+                if closed is not None:
+                    on_record(*closed)
+        parser.partial = lines[-1]
+        if complete and parser.partial:
+            closed = parser.feed(parser.partial.decode('utf-8', 'replace'))
+            parser.partial = b''
+            if closed is not None:
+                on_record(*closed)
+        start = int(response.headers.get('X-Text-Size',
+                                         start + chunks.size))
+    finally:
+        response.close()
+    METRICS.add('console_download', chunks.seconds, chunks.size)
+    METRICS.add('console_parse', time.time() - began - chunks.seconds)
+    return start
+
+
+def _console_key(job_name, build):
+    return '{}-{}-console'.format(job_name, build['id'])
+
+
+def _read_console(job_name, build, db, arches=DEFAULT_ARCHES, live=None):
+    """Parse the console of a build, resuming where the last poll stopped
+
+    The Jenkins offset, the parser state and the TESTING records read so far
+    are kept into the state store.  live is called with each new record of
+    a running build, the sections and TESTING records are returned once the
+    build is finished.
+    """
+    key = _console_key(job_name, build)
+    console = db.get(key) or {'offset': 0, 'parser': None, 'records': []}
+    if console['parser']:
+        parser = ConsoleParser.from_state(console['parser'], arches)
+    else:
+        parser = ConsoleParser(arches)
+    records = console['records']
+    new_records = []
+
+    def on_record(name, d):
+        if name == 'TESTING':
+            records.append(d)
+        new_records.append(d)
+
+    offset = read_progressive_console(build, parser, console['offset'],
+                                      on_record, not build['building'])
+    if not build['building']:
+        return parser.sections, records
+    if live is not None:
+        for d in new_records:
+            live(d)
+    db.set(key, {'offset': offset, 'parser': parser.state(),
+                 'records': records})
+    return None
+
+
+def sync_build(job_name, build, db, pool=None, arches=DEFAULT_ARCHES,
+               submit=None, coalesce=False, live=False):
+    """Post the steps of a Jenkins build, unless it was already done
+
+    With live, the console of a running build is tailed and the steps known
+    to have passed are posted right away.
+    """
+    if build['result'] == 'ABORTED':
+        # Not processing pipelines aborted, nor keeping what was tailed
+        if db.get(_console_key(job_name, build)):
+            db.delete(_console_key(job_name, build))
+        return
+    if build['building']:
+        if live:
+            _read_console(job_name, build, db, arches,
+                          lambda d: post_live_steps(job_name, build, d, db,
+                                                    submit))
+        # Not processing pipelines unfinished
+        return
+    job_id = '{}-{}'.format(job_name, build['id'])
+    if db.get(job_id):
+        return
+    url = '{}/consoleText'.format(build['url'])
+    tailed = db.get(_console_key(job_name, build))
+    if tailed:
+        # Only the end of the console is missing
+        sections, records = _read_console(job_name, build, db, arches)
+    else:
+        sections, records = read_console_records(url, arches)
+    if not sections or len(sections) != 3:
+        # Discard broken pipelines
+        logging.warning('Broken pipeline %s, sections found: %r', url,
+                        sections)
+    else:
+        process_records(job_name, build, records, db, pool, submit, coalesce)
+    sss_save_state(db, job_id)
+    if tailed:
+        db.delete(_console_key(job_name, build))
+
+
+def in_shard(job_name, shard):
+    """Whether job_name belongs to shard, an (index, count) tuple
+
+    crc32 is used since it is the same in every process and on every host.
+    """
+    index, count = shard
+    return zlib.crc32(job_name.encode('utf-8')) % count == index
+
+
+def _lease_key(job_name):
+    return '{}-lease'.format(job_name)
+
+
+def _lease_owner():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def _is_dead_local_owner(owner):
+    """Whether owner is a process of this host which is not running anymore
+
+    Processes killed before releasing their leases would otherwise keep
+    their jobs until the leases expire.
+    """
+    host, _, pid = owner.rpartition('-')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+def _high_water_mark_key(job_name):
+    return '{}-high-water-mark'.format(job_name)
+
+
+def sync_job(server, job_name, db, fetch_all_builds=False, build_pool=None,
+             arch_pool=None, arches=DEFAULT_ARCHES, submit=None,
+             coalesce=False, live=False):
+    """Post the builds of a job newer than its high-water mark
+
+    The mark is the highest build number such that it and every build before
+    it are fully processed, so builds still running are polled again.
+    Jenkins only lists the newest builds without allBuilds, the older ones
+    are posted with fetch_all_builds, which ignores the mark, or a backfill.
+    """
+    mark_key = _high_water_mark_key(job_name)
+    mark = db.get(mark_key, 0)
+    builds = get_builds(server, job_name, fetch_all_builds)
+    if not fetch_all_builds:
+        builds = [build for build in builds if build['number'] > mark]
+    METRICS.count('builds', len(builds))
+    _map(build_pool,
+         lambda build: sync_build(job_name, build, db, arch_pool, arches,
+                                  submit, coalesce, live),
+         builds)
+    new_mark = mark
+    for build in builds:
+        if build['building']:
+            break
+        new_mark = max(new_mark, build['number'])
+    if new_mark != mark:
+        db.set(mark_key, new_mark)
+
+
+def _backfill_key(job_name):
+    return '{}-backfill'.format(job_name)
+
+
+def _skip_builds(server, job_name, wanted, page_size=BACKFILL_SKIP_PAGE_SIZE):
+    """Return the index of the newest build wanted, only reading numbers"""
+    start = 0
+    while True:
+        page = get_build_page(server, job_name, start, start + page_size,
+                              'number,timestamp')
+        for i, build in enumerate(page):
+            if wanted(build):
+                return start + i
+        if len(page) < page_size:
+            return start + len(page)
+        start += len(page)
+
+
+def backfill_job(server, job_name, db, build_pool=None, arch_pool=None,
+                 arches=DEFAULT_ARCHES, submit=None, coalesce=False,
+                 build_range=None, since=None, until=None,
+                 page_size=BACKFILL_PAGE_SIZE):
+    """Post every build of a job a page at a time, newest first
+
+    build_range is a (first, last) tuple of build numbers, None for no
+    bound, since and until bound the build timestamps, in milliseconds.
+    The lowest build number processed is checkpointed after each page, an
+    interrupted backfill resumes below it and skips the builds above with
+    requests for their numbers only.  Once a backfill without bounds is
+    done, the high-water mark of the job is moved to its newest build not
+    running.
+    """
+    first, last = build_range or (None, None)
+    key = _backfill_key(job_name)
+    bounds = [first, last, since, until]
+    checkpoint = db.get(key)
+    if not checkpoint or checkpoint['bounds'] != bounds:
+        checkpoint = {'bounds': bounds, 'below': None, 'newest': None,
+                      'building': None, 'done': False}
+    if checkpoint['done']:
+        logging.info('Backfill of %s already done', job_name)
+        return
+
+    def above_range(build):
+        return ((checkpoint['below'] is not None and
+                 build['number'] >= checkpoint['below']) or
+                (last is not None and build['number'] > last) or
+                (until is not None and build['timestamp'] > until))
+
+    def below_range(build):
+        return ((first is not None and build['number'] < first) or
+                (since is not None and build['timestamp'] < since))
+
+    start = 0
+    if any(bound is not None for bound in (checkpoint['below'], last, until)):
+        start = _skip_builds(server, job_name,
+                             lambda build: not above_range(build))
+    while not checkpoint['done']:
+        page = get_build_page(server, job_name, start, start + page_size)
+        start += len(page)
+        if checkpoint['newest'] is None and page:
+            checkpoint['newest'] = page[0]['number']
+        # Builds started meanwhile shift the pages, they overlap then
+        builds = [build for build in page if not above_range(build)]
+        wanted = [build for build in builds if not below_range(build)]
+        _map(build_pool,
+             lambda build: sync_build(job_name, build, db, arch_pool, arches,
+                                      submit, coalesce),
+             wanted)
+        for build in wanted:
+            if build['building']:
+                checkpoint['building'] = build['number']
+        if builds:
+            checkpoint['below'] = builds[-1]['number']
+        checkpoint['done'] = (len(page) < page_size or
+                              len(wanted) < len(builds))
+        db.set(key, checkpoint)
+        db.commit()
+        logging.info('Backfill of %s at build %s', job_name,
+                     checkpoint['below'])
+    if bounds == [None] * 4 and checkpoint['newest'] is not None:
+        mark_key = _high_water_mark_key(job_name)
+        mark = checkpoint['newest']
+        if checkpoint['building'] is not None:
+            mark = checkpoint['building'] - 1
+        db.set(mark_key, max(mark, db.get(mark_key, 0)))
+
+
+def watch_jobs(job_names, interval, sync, stop):
+    """Call sync on each job every interval(job_name) seconds until stop
+
+    A job failing is logged and polled again at its next turn.
+    """
+    # Jobs due at the same time are polled in the order they are tracked
+    schedule = [(0, i, job_name) for i, job_name in enumerate(job_names)]
+    heapq.heapify(schedule)
+    while schedule and not stop.is_set():
+        due, i, job_name = schedule[0]
+        delay = due - time.time()
+        if delay > 0:
+            stop.wait(delay)
+            continue
+        heapq.heappop(schedule)
+        try:
+            sync(job_name)
+        except Exception:
+            logging.exception('Polling %s failed', job_name)
+        heapq.heappush(schedule,
+                       (time.time() + interval(job_name), i, job_name))
 
 
 def process_jenkins_jobs():
@@ -403,63 +2417,423 @@ def process_jenkins_jobs():
         ' Jenkins will only return the most recent 100 builds per job name',
         action='store_true',
     )
+    parser.add_argument(
+        '--backfill',
+        help='Post every build of the jobs, newest first and a page of builds'
+        ' at a time. The progress is saved after each page and an'
+        ' interrupted backfill resumes where it stopped',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--backfill-page-size',
+        help='Number of builds per page of a backfill',
+        type=int,
+        default=BACKFILL_PAGE_SIZE,
+    )
+    parser.add_argument(
+        '--build-range',
+        help='Only backfill the builds numbered FIRST to LAST, either can be'
+        ' left out',
+        type=_build_range,
+        metavar='FIRST-LAST',
+    )
+    parser.add_argument(
+        '--since',
+        help='Only backfill the builds started on or after this date',
+        type=_timestamp,
+        metavar='YYYY-MM-DD',
+    )
+    parser.add_argument(
+        '--until',
+        help='Only backfill the builds started before this date',
+        type=_timestamp,
+        metavar='YYYY-MM-DD',
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of builds, and of arches within a build, processed in'
+        ' parallel. The steps of each arch are always posted in order',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--coalesce',
+        help='Submit the merge, build and test steps of each build arch as'
+        ' a single Squad test run, whose job_id is <build id>-<arch>,'
+        ' instead of one test run per step and Beaker task',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--outbox',
+        help='Queue the submissions into this SQLite outbox, a background'
+        ' sender drains it while builds are collected and what is left is'
+        ' sent by the next run or by sss_outbox',
+    )
+    parser.add_argument(
+        '--live',
+        help='Tail the console of running builds and post their merge and'
+        ' build steps as soon as they passed, tests are posted once the'
+        ' build finishes',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--watch',
+        help='Keep running and poll each job every INTERVAL seconds, or'
+        ' every config.JOB_POLL_INTERVALS[job] seconds, until SIGTERM',
+        type=float,
+        metavar='INTERVAL',
+    )
+    parser.add_argument(
+        '--state-store',
+        help='Backend keeping track of the steps already posted',
+        choices=sorted(STATE_STORES),
+        default='sqlite',
+    )
+    parser.add_argument(
+        '--state-path',
+        help='Path of the state store, sss_state.sqlite3 for sqlite and'
+        ' sss_cache.db for pickledb by default',
+    )
+    parser.add_argument(
+        '--state-batch-size',
+        help='Number of steps saved between two commits of the state store',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--migrate-from',
+        help='pickledb file imported when the sqlite state store is empty',
+        default='sss_cache.db',
+    )
+    parser.add_argument(
+        '--shard',
+        help='Only sync the tracked jobs of shard INDEX out of COUNT, e.g.'
+        ' run "--shard 0/2" on a host and "--shard 1/2" on another one.'
+        ' {shard} into --state-path and --outbox is replaced by INDEX',
+        type=_shard,
+        metavar='INDEX/COUNT',
+        default=(0, 1),
+    )
+    parser.add_argument(
+        '--shards',
+        help='Sync the tracked jobs from N processes, one per shard',
+        type=int,
+        metavar='N',
+        default=1,
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Write the time, calls and bytes of each stage, the request'
+        ' counts, the cache hit rates and the host limits of the run into'
+        ' this JSON file. {shard} is replaced by the shard INDEX',
+    )
+    parser.add_argument(
+        '--metrics-port',
+        help='Serve the metrics in the Prometheus format on this port, the'
+        ' shard INDEX is added to it',
+        type=int,
+        metavar='PORT',
+    )
+    parser.add_argument(
+        '--profile',
+        help='cProfile every thread of the run and dump the stats into this'
+        ' file, to be read with pstats. {shard} is replaced by the shard'
+        ' INDEX',
+    )
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be greater than zero')
+    if args.shards < 1:
+        parser.error('--shards must be greater than zero')
+    if (args.state_store == 'pickledb' and
+            (args.shards > 1 or args.shard[1] > 1) and
+            '{shard}' not in (args.state_path or '')):
+        # pickledb has no leases, shards would rewrite each other's file
+        parser.error('sharding with the pickledb state store needs a'
+                     ' --state-path containing {shard}')
+    if args.backfill and args.watch:
+        parser.error('--backfill and --watch are exclusive')
+    if not args.backfill and (args.build_range or args.since or args.until):
+        parser.error('--build-range, --since and --until need --backfill')
+    if args.shards > 1:
+        return run_shards(args)
+    return run_jenkins_jobs(args)
+
+
+def _shard(value):
+    try:
+        index, count = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not INDEX/COUNT'.format(value))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('{} is not a shard'.format(value))
+    return index, count
+
 
+def _build_range(value):
+    try:
+        first, last = [int(x) if x else None for x in value.split('-')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not FIRST-LAST'.format(value))
+    return first, last
+
+
+def _timestamp(value):
+    """Return the date as a Jenkins timestamp, in milliseconds"""
+    try:
+        date = datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not YYYY-MM-DD'.format(value))
+    return int(time.mktime(date.timetuple())) * 1000
+
+
+def run_shards(args):
+    """Run a process per shard, SIGTERM is forwarded to all of them"""
+    import multiprocessing
+    processes = []
+    for index in range(args.shards):
+        shard_args = argparse.Namespace(**vars(args))
+        shard_args.shard = (index, args.shards)
+        shard_args.shards = 1
+        processes.append(multiprocessing.Process(
+            target=run_jenkins_jobs, args=(shard_args,),
+            name='shard-{}'.format(index),
+        ))
+        processes[-1].start()
+
+    def terminate(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, terminate)
+    for process in processes:
+        process.join()
+    return 1 if any(process.exitcode for process in processes) else 0
+
+
+def run_jenkins_jobs(args):
     host = get_varenv_or_raise('JENKINS_HOST', MissingJENKINS_HOST)
     username = get_varenv_or_raise('JENKINS_USERNAME', MissingJENKINS_USERNAME)
     password = get_varenv_or_raise('JENKINS_PASSWORD', MissingJENKINS_PASSWORD)
-    server = jenkins.Jenkins(host, username=username, password=password)
-    db = pickledb.load('sss_cache.db', False)
+    server = get_jenkins_server(host, username, password)
+    state_path = (args.state_path or {
+        'sqlite': 'sss_state.sqlite3',
+        'pickledb': 'sss_cache.db',
+    }[args.state_store]).format(shard=args.shard[0])
+    db = open_state_store(args.state_store, state_path,
+                          args.state_batch_size, args.migrate_from)
     try:
         import config
     except ImportError:
         raise Exception('Missing config.py')
-    for job_name in config.JOB_NAMES_TRACKED:
-        job_info = server.get_job_info(job_name,
-                                       fetch_all_builds=args.all_builds)
-        builds = sorted(job_info['builds'], key=lambda x: x['number'])
-        for build in builds:
-            build_info = server.get_build_info(job_name, build['number'])
-            if build_info['building'] or build_info['result'] == 'ABORTED':
-                # Not processing pipelines unfinished neither aborted
-                continue
-            job_id = '{}-{}'.format(job_name, build_info['id'])
-            if db.get(job_id):
-                continue
-            url = '{}/consoleText'.format(build['url'])
-            response = requests.get(url)
-            console_text = response.content
-            sections = get_sections(console_text)
-            if not sections or len(sections) != 3:
-                # Discard broken pipelines
-                logging.warning('Broken pipeline\n%r', console_text)
-                sss_save_state(db, job_id)
-                continue
+    job_names = [job_name for job_name in config.JOB_NAMES_TRACKED
+                 if in_shard(job_name, args.shard)]
+    http = get_http_client()
+    profiler = metrics_server = None
+    if args.profile:
+        profiler = Profiler()
+        profiler.start()
+    if args.metrics_port is not None:
+        metrics_server = serve_metrics(args.metrics_port + args.shard[0],
+                                       http.controller.limits)
+    submit = sender = None
+    if args.outbox:
+        outbox = Outbox(args.outbox.format(shard=args.shard[0]))
+        submit = outbox.put
+        sender = OutboxSender(outbox)
+        sender.start()
+    # Builds and arches need their own pools, a build waiting for its arches
+    # must not hold the only threads able to run them
+    build_pool = arch_pool = None
+    if args.workers > 1:
+        build_pool = ThreadPool(args.workers)
+        arch_pool = ThreadPool(args.workers)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: logging.info(
+            'Host limits: %s',
+            json.dumps(http.controller.limits(), sort_keys=True)
+        ))
+    # Shards sharing a state store never sync the same job at the same time,
+    # even when they disagree on the number of shards
+    sharded = args.shard[1] > 1
+    owner = _lease_owner()
+
+    def sync(job_name):
+        if sharded and not db.acquire(_lease_key(job_name), owner,
+                                      JOB_LEASE_TTL, _is_dead_local_owner):
+            logging.warning('%s is synced by another process', job_name)
+            return
+        arches = getattr(config, 'ARCHES', DEFAULT_ARCHES)
+        try:
+            if args.backfill:
+                until = args.until and args.until - 1
+                backfill_job(server, job_name, db, build_pool, arch_pool,
+                             arches, submit, args.coalesce, args.build_range,
+                             args.since, until, args.backfill_page_size)
+            else:
+                sync_job(server, job_name, db, args.all_builds, build_pool,
+                         arch_pool, arches, submit, args.coalesce,
+                         args.live)
+            db.commit()
+        finally:
+            if sharded:
+                db.release(_lease_key(job_name), owner)
+
+    try:
+        if args.watch:
+            stop = threading.Event()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda signum, frame: stop.set())
+            intervals = getattr(config, 'JOB_POLL_INTERVALS', {})
+            watch_jobs(job_names,
+                       lambda job_name: intervals.get(job_name, args.watch),
+                       sync, stop)
+            logging.info('Stopping, flushing the state')
+        else:
+            for job_name in job_names:
+                sync(job_name)
+    finally:
+        for pool in (build_pool, arch_pool):
+            if pool is not None:
+                pool.close()
+                pool.join()
+        db.close()
+        if sender is not None:
+            sender.stop()
+            if len(sender.outbox):
+                logging.warning('%d submissions left into %s',
+                                len(sender.outbox), args.outbox)
+            sender.outbox.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        if profiler is not None:
+            profiler.dump(args.profile.format(shard=args.shard[0]))
+        if args.metrics_file:
+            with open(args.metrics_file.format(shard=args.shard[0]),
+                      'w') as fh:
+                json.dump(METRICS.summary(http.controller.limits()), fh,
+                          indent=2, sort_keys=True)
+
+
+def drain_outbox():
+    logging.basicConfig(format="%(created)10.6f:%(levelname)s: %(message)s")
+    logging.getLogger().setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+    parser = argparse.ArgumentParser(
+        description='Send to Squad the submissions queued by sss_jenkins'
+        ' --outbox. Submissions rejected for good, or failing too many'
+        ' times, are set aside as dead until --retry-dead.'
+    )
+    parser.add_argument('outbox', help='Path of the outbox')
+    parser.add_argument(
+        '--retry-dead',
+        help='Queue the dead submissions again before draining',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--loop',
+        help='Keep draining the outbox every INTERVAL seconds',
+        type=float,
+        metavar='INTERVAL',
+    )
+    args = parser.parse_args()
+    outbox = Outbox(args.outbox)
+    try:
+        if args.retry_dead:
+            logging.info('%d dead submissions queued again',
+                         outbox.retry_dead())
+        while True:
+            sent = outbox.drain()
+            logging.info('%d submissions sent, %d left, %d dead', sent,
+                         len(outbox), outbox.dead())
+            if not args.loop:
+                break
+            time.sleep(args.loop)
+        return 1 if len(outbox) else 0
+    finally:
+        outbox.close()
+
+
+BATCH_ACTIONS = ('merge', 'build', 'test')
+BATCH_STATES = ('skip', 'pass', 'fail')
 
-            process_build(job_name, build, build_info, sections, db)
-            sss_save_state(db, job_id)
 
+def post_step(step):
+    """Post one step described by a dict with the same fields as sss args
 
-def main():
+    The skt rc is read from skt_rc_path, or given as is into skt_rc.
+    """
+    metadata = {
+        'job_id': step['job_id'],
+        'build_url': step['build_url'],
+    }
+    if step['action'] not in BATCH_ACTIONS:
+        raise ValueError('Unknown action {!r}'.format(step['action']))
+    if step['action'] != 'test' and step['state'] not in BATCH_STATES:
+        raise ValueError('Unknown state {!r}'.format(step['state']))
+    if 'skt_rc' in step:
+        skt_rc = step['skt_rc']
+    else:
+        skt_rc = read_skt_rc_state(step['skt_rc_path'])
+    if step['action'] == 'merge':
+        post_merge_data(step['project'], step['arch'], step['source_id'],
+                        step['state'], skt_rc, metadata)
+    elif step['action'] == 'build':
+        post_build_data(step['project'], step['arch'], step['source_id'],
+                        step['state'], skt_rc, metadata)
+    elif step['action'] == 'test':
+        post_test_data(step['project'], step['arch'], step['source_id'],
+                       skt_rc, metadata)
+
+
+def batch(argv):
+    """Post every step of a JSONL stream, return the number of failures"""
+    parser = argparse.ArgumentParser(
+        prog='sss batch',
+        description='Push SKT steps to Squad, one JSON object per line with'
+        ' the fields of sss arguments, e.g. {"action": "merge", "project":'
+        ' ..., "source_id": ..., "arch": ..., "state": ..., "skt_rc_path":'
+        ' ..., "job_id": ..., "build_url": ...}. skt_rc can carry the skt rc'
+        ' content instead of skt_rc_path.'
+    )
+    parser.add_argument('file', nargs='?', default='-',
+                        help='JSONL file, stdin by default')
+    args = parser.parse_args(argv)
+    fh = sys.stdin if args.file == '-' else open(args.file)
+    failures = 0
+    try:
+        for lineno, line in enumerate(fh, 1):
+            if not line.strip():
+                continue
+            try:
+                post_step(json.loads(line))
+            except Exception:
+                logging.exception('Step at line %d failed', lineno)
+                failures += 1
+    finally:
+        if fh is not sys.stdin:
+            fh.close()
+    return failures
+
+
+def main(argv=None):
     logging.basicConfig(format="%(created)10.6f:%(levelname)s:%(message)s")
     logging.getLogger().setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
-    parser = argparse.ArgumentParser(description='Push SKT steps to Squad.')
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['batch']:
+        return 1 if batch(argv[1:]) else 0
+    parser = argparse.ArgumentParser(description='Push SKT steps to Squad.'
+                                     ' Run "sss batch -h" to push many steps'
+                                     ' from a single process.')
     parser.add_argument('--project', help='Same name that jenkins pipeline', required=True)
     parser.add_argument('--source-id', help='Githash plus patchids appendend by a _ or something similar', required=True)
     parser.add_argument('--arch', help='Architecture', required=True)
-    parser.add_argument('--state', help='State of the action', required=True, choices=['skip', 'pass', 'fail'])
+    parser.add_argument('--state', help='State of the action', required=True, choices=BATCH_STATES)
     parser.add_argument('--skt-rc-path', help='Path to skt rc file', required=True)
     parser.add_argument('--job-id', help='Unique id for the task, maybe jenkins_job+action e.g. 234+merge', required=True)
     parser.add_argument('--build-url', help='URL pointing to the jenkins job', required=True)
-    parser.add_argument('--action', help='Actions', choices=['merge', 'build', 'test'], required=True)
-    args = parser.parse_args()
-    metadata = {
-        'job_id': args.job_id,
-        'build_url': args.build_url,
-    }
-    if args.action == 'merge':
-        post_merge_info(args.project, args.arch, args.source_id, args.state, args.skt_rc_path, metadata)
-    elif args.action == 'build':
-        post_build_info(args.project, args.arch, args.source_id, args.state, args.skt_rc_path, metadata)
-    elif args.action == 'test':
-        post_test_info(args.project, args.arch, args.source_id, args.skt_rc_path, metadata)
+    parser.add_argument('--action', help='Actions', choices=BATCH_ACTIONS, required=True)
+    args = parser.parse_args(argv)
+    post_step(vars(args))
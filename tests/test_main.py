@@ -1,6 +1,18 @@
 import unittest
+import io
 import os
+import json
+import gzip
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from email.parser import BytesParser
+from multiprocessing.pool import ThreadPool
 import mock
+import requests
+import jenkins
 import sss
 
 
@@ -15,6 +27,21 @@ def get_asset_content(filename):
         return fh.read()
 
 
+class FakeDB(sss.StateStore):
+    """In memory stand-in for the state store"""
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value=True):
+        self.data[key] = value
+
+    def delete(self, key):
+        del self.data[key]
+
+
 class TestMain(unittest.TestCase):
     def test_get_merge_metadata(self):
         data = {}
@@ -112,3 +139,996 @@ class TestMain(unittest.TestCase):
                 'cfgurl_arm': 'http://xci33.lab.eng.rdu2.redhat.com/builds/ppc64le/ef7cec3e560720ddd2fde2bf824761087c025a32.csv.config',
             }
             self.assertDictEqual(metadata_expected, metadata)
+
+    def test_post_data_from_skt_rc(self):
+        skt_rc = get_asset_content('skt_rc_0')
+        for rc in (skt_rc, sss.parse_skt_rc(skt_rc)):
+            with mock.patch('sss.do_request') as mock_do_request:
+                sss.post_build_data('prj', 'arm', 'e96d38e6e7', 'pass', rc,
+                                    {})
+            with mock.patch('sss.do_request') as mock_path_do_request:
+                sss.post_build_info('prj', 'arm', 'e96d38e6e7', 'pass',
+                                    get_asset_path('skt_rc_0'), {})
+            self.assertEqual(mock_path_do_request.mock_calls,
+                             mock_do_request.mock_calls)
+        self.assertEqual('e96d38e6.patch.229746', sss._source_id(skt_rc))
+
+    def test_console_parser(self):
+        console = ['noise', 'BUILD STATE after MERGE', '[Pipeline] echo']
+        for arch in ('x86_64', 's390x'):
+            console += ['{}:'.format(arch), 'status: Merged',
+                        'skt configuration:', '[state]', 'basehead = 1234',
+                        '[Pipeline] echo']
+        console += ['[Pipeline] stage', 'noise', 'BUILD STATE after TESTING',
+                    'x86_64:', 'status: Passed', 'skt configuration:',
+                    '[state]', '[Pipeline] }', '[Pipeline] stage']
+        sections = sss.get_sections('\n'.join(console))
+        parser = sss.ConsoleParser()
+        self.assertEqual(
+            [(name, d) for name in ('MERGE', 'TESTING')
+             for d in sss.parse_section(sections[name])],
+            list(parser.parse(console)),
+        )
+        self.assertEqual(['MERGE', 'TESTING'], parser.sections)
+        parser = sss.ConsoleParser(['s390x'])
+        self.assertEqual(['s390x'],
+                         [d['arch'] for name, d in parser.parse(console)])
+
+    def test_get_test_results(self):
+        response = mock.Mock()
+        with open(get_asset_path('recipe_0.xml'), 'rb') as fh:
+            response.raw = io.BytesIO(fh.read())
+        with mock.patch('sss.get_http_client') as mock_http, \
+                mock.patch.dict(os.environ, {'SSS_BEAKER_CACHE_DIR': ''}):
+            mock_http.return_value.get.return_value = response
+            tests = sss.iter_test_results('https://beaker', '3')
+            self.assertNotIsInstance(tests, list)
+            tests = list(tests)
+        mock_http.return_value.get.assert_called_once_with(
+            'https://beaker/recipes/3.xml', stream=True, headers={})
+        self.assertTrue(response.close.called)
+        self.assertEqual([
+            {'name': '/kernel/networking/ipv4', 'result': 'Pass',
+             'id': '102', 'url_log': 'https://beaker/102/log'},
+            {'name': '/kernel/networking/ipv6', 'result': 'Fail',
+             'id': '103', 'url_log': 'https://beaker/103/log'},
+            {'name': '/kernel/misc//', 'result': 'Pass',
+             'id': '105', 'url_log': 'https://beaker/105/log'},
+        ], tests)
+
+    def test_post_test_data_machine_recipes(self):
+        recipeset = {'machine_recipes': [
+            {'recipe_id': 1, 'tasks': [{'id': 10, 'name': '/kernel/a'},
+                                       {'id': 11, 'name': '/distro/b'}]},
+            {'recipe_id': 2, 'tasks': [{'id': 20, 'name': '/kernel/a'},
+                                       {'id': 21, 'name': '/kernel/c'}]},
+        ]}
+        posted = []
+
+        def post_task(beaker_host, url, task, metadata, beaker_result,
+                      submit=None):
+            metadata['job_id'] = task['id']
+            posted.append((task['id'], beaker_result, metadata))
+
+        with mock.patch('sss.get_recipeset', return_value=recipeset), \
+                mock.patch('sss.get_test_results',
+                           side_effect=lambda host, recipe_id: [recipe_id]), \
+                mock.patch('sss.post_task', post_task):
+            sss.post_test_data('prj', 'arm', 'e96d38e6e7',
+                               get_asset_content('skt_rc_0'), {})
+        self.assertEqual([(10, [1]), (20, [2]), (21, [2])],
+                         sorted((task_id, r) for task_id, r, m in posted))
+        self.assertEqual([10, 20, 21],
+                         sorted(m['job_id'] for task_id, r, m in posted))
+
+    def test_coalesced_submission_threads(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        submission = sss.CoalescedSubmission('7-x86_64')
+        self.addCleanup(submission.close)
+        move = shutil.move
+
+        def slow_move(src, dst):
+            time.sleep(0.001)
+            return move(src, dst)
+
+        def post_task(i):
+            os.mkdir(os.path.join(tmpdir, str(i)))
+            filepath = os.path.join(tmpdir, str(i), 'taskout.log')
+            with open(filepath, 'w') as fh:
+                fh.write(str(i))
+            submission('api/submit', {}, {'job_id': str(i)}, [filepath])
+
+        pool = ThreadPool(4)
+        with mock.patch('shutil.move', slow_move):
+            pool.map(post_task, range(8))
+        pool.close()
+        pool.join()
+        self.assertEqual(8, len(set(submission.files)))
+        contents = set()
+        for filepath in submission.files:
+            with open(filepath) as fh:
+                contents.add(fh.read())
+        self.assertEqual(set(str(i) for i in range(8)), contents)
+
+    def test_coalesced_submission_collision(self):
+        submitted = []
+
+        def submit(url, test_result, metadata, files=None, metrics=None):
+            submitted.append((test_result, metadata, metrics))
+
+        submission = sss.CoalescedSubmission('7-x86_64', submit)
+        self.addCleanup(submission.close)
+        for task_id, result in (('1', 'Fail'), ('2', 'Pass')):
+            submission('api/submit', {'/kernel/net/ping': result},
+                       {'job_id': task_id},
+                       metrics={'/kernel/net/duration': 1})
+        submission.flush()
+        self.assertEqual([
+            ({'/kernel/net/ping': 'Pass'}, {'job_id': '2'},
+             {'/kernel/net/duration': 1}),
+            ({'/kernel/net/ping': 'Fail'},
+             {'job_id': '7-x86_64', 'coalesced_job_ids': ['1']},
+             {'/kernel/net/duration': 1}),
+        ], submitted)
+
+    def test_process_arch_coalesce(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        data_parsed = {'arch': 'x86_64', 'status': 'Passed',
+                       'skt_rc': get_asset_content('skt_rc_0')}
+        build_info = {'id': '7', 'url': 'url', 'timestamp': 0}
+
+        def post_test_data(project, arch, source_id, skt_rc, metadata,
+                           submit=None):
+            for task in ('a', 'b'):
+                filepath = os.path.join(tmpdir, 'task.log')
+                with open(filepath, 'w') as fh:
+                    fh.write(task)
+                submit('api/submit/KERNELCI/prj/e96d38e6.patch.229746/x86_64',
+                       {'/kernel/' + task: 'PASS'},
+                       dict(metadata, job_id=task), [filepath],
+                       {'/kernel/{}/duration'.format(task): 1})
+
+        submitted = []
+
+        def do_request(url, test_result, metadata, files=None, metrics=None):
+            contents = []
+            for filepath in files:
+                with open(filepath) as fh:
+                    contents.append((os.path.basename(filepath), fh.read()))
+            submitted.append((test_result, metadata['job_id'],
+                              metadata['coalesced_job_ids'], contents,
+                              metrics))
+
+        db = FakeDB()
+        db.set('7-x86_64-merge')
+        with mock.patch('sss.post_test_data', post_test_data), \
+                mock.patch('sss.do_request', do_request):
+            sss.process_arch('prj', build_info, build_info, data_parsed, db,
+                             coalesce=True)
+        self.assertEqual([(
+            {'/build/': 'pass', '/kernel/a': 'PASS', '/kernel/b': 'PASS'},
+            '7-x86_64',
+            ['7-x86_64-build', 'a', 'b'],
+            [('task.log', 'a'), ('b-task.log', 'b')],
+            {'/kernel/a/duration': 1, '/kernel/b/duration': 1},
+        )], submitted)
+        for step in ('merge', 'build', 'test'):
+            self.assertTrue(db.get('7-x86_64-{}'.format(step)))
+
+    def test_sync_build_live(self):
+        skt_rc = get_asset_content('skt_rc_0').splitlines()
+        console = ''
+        for section, status in (('MERGE', 'Merged'), ('BUILD', 'Built'),
+                                ('TESTING', 'Passed')):
+            console += '\n'.join(
+                ['[Pipeline] stage', 'BUILD STATE after ' + section,
+                 'x86_64:', 'status: ' + status, 'skt configuration:'] +
+                skt_rc + ['[Pipeline] }', '']
+            )
+        console = console.encode('utf-8')
+        # Polls stop in the middle of a line of BUILD, then of TESTING
+        ends = [console.index(b'status: Built') + 3,
+                console.index(b'status: Passed') + 3,
+                len(console)]
+        # The raw log is longer than its text, with the console notes
+        sizes = [end + 100 * (i + 1) for i, end in enumerate(ends)]
+        requests_start = []
+
+        def get(url, params, stream):
+            self.assertEqual('url/logText/progressiveText', url)
+            requests_start.append(params['start'])
+            poll = len(requests_start) - 1
+            response = mock.Mock()
+            response.headers = {'X-Text-Size': str(sizes[poll])}
+            response.iter_content.return_value = [
+                console[([0] + ends)[poll]:ends[poll]]
+            ]
+            return response
+
+        build = {'id': '7', 'url': 'url', 'building': True, 'result': None,
+                 'timestamp': 0}
+        db = FakeDB()
+        steps = []
+
+        def post_step(step):
+            def post(project, arch, source_id, *args):
+                steps.append(step)
+            return post
+
+        with mock.patch('sss.get_http_client') as mock_http, \
+                mock.patch('sss.post_merge_data', post_step('merge')), \
+                mock.patch('sss.post_build_data', post_step('build')), \
+                mock.patch('sss.post_test_data', post_step('test')):
+            mock_http.return_value.get.side_effect = get
+            sss.sync_build('job', build, db, live=True)
+            self.assertEqual(['merge'], steps)
+            sss.sync_build('job', build, db, live=True)
+            self.assertEqual(['merge', 'build'], steps)
+            build['building'] = False
+            sss.sync_build('job', build, db, live=True)
+        self.assertEqual(['merge', 'build', 'test'], steps)
+        self.assertEqual([0] + sizes[:2], requests_start)
+        self.assertTrue(db.get('job-7'))
+        self.assertIsNone(db.get('job-7-console'))
+
+    def test_sync_build_live_aborted(self):
+        build = {'id': '7', 'url': 'url', 'building': True, 'result': None,
+                 'timestamp': 0}
+        db = FakeDB()
+        response = mock.Mock(headers={'X-Text-Size': '17'})
+        response.iter_content.return_value = [b'[Pipeline] stage\n']
+        with mock.patch('sss.get_http_client') as mock_http:
+            mock_http.return_value.get.return_value = response
+            sss.sync_build('job', build, db, live=True)
+        self.assertTrue(db.get('job-7-console'))
+        build.update(building=False, result='ABORTED')
+        sss.sync_build('job', build, db, live=True)
+        self.assertIsNone(db.get('job-7-console'))
+        self.assertIsNone(db.get('job-7'))
+
+    def test_process_build_workers(self):
+        skt_rc = ['[state]', 'basehead = e96d38e6e7ae0ee3',
+                  'patchwork_00 = http://patchwork/patch/229746']
+        section = []
+        for arch in ('x86_64', 'ppc64le', 'aarch64'):
+            section += ['{}:'.format(arch), 'status: Passed',
+                        'skt configuration:'] + skt_rc + ['[Pipeline] }']
+        db = FakeDB()
+        build_info = {'id': '7', 'url': 'url', 'timestamp': 0}
+        steps = []
+
+        def post_step(step):
+            def post(project, arch, *args):
+                steps.append((arch, step))
+            return post
+
+        pool = ThreadPool(3)
+        with mock.patch('sss.post_merge_data', post_step('merge')), \
+                mock.patch('sss.post_build_data', post_step('build')), \
+                mock.patch('sss.post_test_data', post_step('test')):
+            sss.process_build('prj', {'url': 'url'}, build_info,
+                              {'TESTING': section}, db, pool)
+        pool.close()
+        pool.join()
+        for arch in ('x86_64', 'ppc64le', 'aarch64'):
+            self.assertEqual(['merge', 'build', 'test'],
+                             [step for a, step in steps if a == arch])
+            for step in ('merge', 'build', 'test'):
+                self.assertTrue(db.get('7-{}-{}'.format(arch, step)))
+
+    def test_sync_job_high_water_mark(self):
+        def build(number, building=False):
+            return {'number': number, 'id': str(number), 'url': 'url',
+                    'building': building, 'result': None, 'timestamp': 0}
+        server = jenkins.Jenkins('http://jenkins')
+        builds = [build(3), build(1), build(2), build(4, True), build(5)]
+        db = FakeDB()
+        with mock.patch.object(server, 'jenkins_open') as mock_open, \
+                mock.patch('sss.sync_build') as mock_sync_build, \
+                mock.patch.dict(os.environ, {'SSS_JENKINS_CACHE_DIR': ''}):
+            mock_open.return_value = json.dumps({'builds': builds})
+            sss.sync_job(server, 'job', db)
+            request = mock_open.mock_calls[0][1][0]
+            self.assertIn('tree=builds[', request.url)
+            self.assertEqual([1, 2, 3, 4, 5],
+                             [c[1][1]['number']
+                              for c in mock_sync_build.mock_calls])
+            self.assertEqual(3, db.get('job-high-water-mark'))
+
+            mock_sync_build.reset_mock()
+            sss.sync_job(server, 'job', db)
+            self.assertEqual([4, 5],
+                             [c[1][1]['number']
+                              for c in mock_sync_build.mock_calls])
+
+    def test_sync_job_partial_builds_list(self):
+        def build(number):
+            return {'number': number, 'id': str(number), 'url': 'url',
+                    'building': False, 'result': None, 'timestamp': 0}
+        server = jenkins.Jenkins('http://jenkins')
+        db = FakeDB()
+        with mock.patch.object(server, 'jenkins_open') as mock_open, \
+                mock.patch('sss.sync_build') as mock_sync_build, \
+                mock.patch.dict(os.environ, {'SSS_JENKINS_CACHE_DIR': ''}):
+            # Only the newest 100 builds out of 500 are listed
+            mock_open.return_value = json.dumps(
+                {'builds': [build(n) for n in range(401, 501)]})
+            sss.sync_job(server, 'job', db)
+            self.assertEqual(100, len(mock_sync_build.mock_calls))
+            self.assertEqual(500, db.get('job-high-water-mark'))
+
+            # The mark is ignored with allBuilds
+            mock_sync_build.reset_mock()
+            mock_open.return_value = json.dumps(
+                {'allBuilds': [build(n) for n in range(1, 501)]})
+            sss.sync_job(server, 'job', db, fetch_all_builds=True)
+            self.assertEqual(500, len(mock_sync_build.mock_calls))
+            self.assertEqual(500, db.get('job-high-water-mark'))
+
+    def test_backfill_job(self):
+        # 10 builds, 8 still running, newest first
+        builds = [{'number': number, 'id': str(number), 'url': 'url',
+                   'building': number == 8, 'result': None,
+                   'timestamp': number * 1000}
+                  for number in range(10, 0, -1)]
+        requests_sent = []
+
+        def jenkins_open(request):
+            tree = request.url.split('tree=')[1]
+            fields = tree.split('[')[1].split(']')[0].split(',')
+            start, stop = [int(x) for x in
+                           tree.split('{')[1].rstrip('}').split(',')]
+            requests_sent.append((fields, start))
+            return json.dumps({'allBuilds': [
+                dict((k, build[k]) for k in fields)
+                for build in builds[start:stop]
+            ]})
+
+        server = jenkins.Jenkins('http://jenkins')
+        db = FakeDB()
+        synced = []
+        crashed = []
+
+        def sync_build(job_name, build, db, *args):
+            synced.append(build['number'])
+            if build['number'] == 4 and not crashed:
+                crashed.append(build['number'])
+                raise RuntimeError('crash')
+
+        with mock.patch.object(server, 'jenkins_open', jenkins_open), \
+                mock.patch('sss.sync_build', sync_build), \
+                mock.patch.dict(os.environ, {'SSS_JENKINS_CACHE_DIR': ''}):
+            with self.assertRaises(RuntimeError):
+                sss.backfill_job(server, 'job', db, page_size=3)
+            self.assertEqual(5, db.get('job-backfill')['below'])
+            # Builds 10 to 5 are skipped reading their numbers only
+            del requests_sent[:]
+            sss.backfill_job(server, 'job', db, page_size=3)
+            self.assertEqual(['number', 'timestamp'], requests_sent[0][0])
+            self.assertEqual(6, requests_sent[1][1])
+            self.assertEqual([10, 9, 8, 7, 6, 5, 4, 4, 3, 2, 1], synced)
+            self.assertTrue(db.get('job-backfill')['done'])
+            self.assertEqual(7, db.get('job-high-water-mark'))
+
+            del synced[:]
+            sss.backfill_job(server, 'job', db, page_size=3,
+                             build_range=(3, 9), until=6000)
+            self.assertEqual([6, 5, 4, 3], synced)
+            self.assertTrue(db.get('job-backfill')['done'])
+
+    def test_batch(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        step = {
+            'project': 'prj', 'source_id': 'e96d38e6e7', 'arch': 'arm',
+            'state': 'pass', 'job_id': '7-arm-merge', 'build_url': 'url',
+            'action': 'merge', 'skt_rc_path': get_asset_path('skt_rc_0'),
+        }
+        steps_path = os.path.join(tmpdir, 'steps.jsonl')
+        with open(steps_path, 'w') as fh:
+            fh.write(json.dumps(step) + '\n\n')
+            fh.write(json.dumps(dict(step, action='unknown')) + '\n')
+            step = dict(step, action='build', job_id='7-arm-build')
+            del step['skt_rc_path']
+            step['skt_rc'] = get_asset_content('skt_rc_0')
+            fh.write(json.dumps(step) + '\n')
+        with mock.patch('sss.do_request') as mock_do_request:
+            self.assertEqual(1, sss.main(['batch', steps_path]))
+        self.assertEqual(
+            [({'/merge/': 'pass'}, '7-arm-merge'),
+             ({'/build/': 'pass'}, '7-arm-build')],
+            [(c[1][1], c[1][2]['job_id'])
+             for c in mock_do_request.mock_calls]
+        )
+
+    def test_watch_jobs(self):
+        stop = threading.Event()
+        polled = []
+
+        def sync(job_name):
+            polled.append(job_name)
+            if len(polled) == 6:
+                stop.set()
+            if job_name == 'broken':
+                raise Exception('Jenkins is down')
+
+        intervals = {'fast': 0, 'slow': 60, 'broken': 0}
+        sss.watch_jobs(['slow', 'fast', 'broken'], intervals.get, sync, stop)
+        self.assertEqual(['slow', 'fast', 'broken', 'fast', 'broken', 'fast'],
+                         polled)
+
+
+class TestStateStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'state.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sqlite_state_store(self):
+        db = sss.SqliteStateStore(self.path, batch_size=2)
+        self.assertIsNone(db.get('7-x86_64-merge'))
+        sss.sss_save_state(db, '7-x86_64-merge')
+        db.set('mark', {'number': 7})
+        db.close()
+        db = sss.SqliteStateStore(self.path)
+        self.assertTrue(db.get('7-x86_64-merge'))
+        self.assertEqual({'number': 7}, db.get('mark'))
+        db.close()
+
+    def test_acquire(self):
+        db = sss.SqliteStateStore(self.path)
+        other = sss.SqliteStateStore(self.path)
+        self.assertTrue(db.acquire('job-lease', 'host-1', 60))
+        self.assertTrue(db.acquire('job-lease', 'host-1', 60))
+        self.assertFalse(other.acquire('job-lease', 'host-2', 60))
+        db.release('job-lease', 'host-2')
+        self.assertFalse(other.acquire('job-lease', 'host-2', 60))
+        db.release('job-lease', 'host-1')
+        self.assertTrue(other.acquire('job-lease', 'host-2', -1))
+        # Expired leases are taken over
+        self.assertTrue(db.acquire('job-lease', 'host-1', 60))
+        db.close()
+        other.close()
+
+    def test_acquire_dead_owner(self):
+        db = sss.SqliteStateStore(self.path)
+        self.addCleanup(db.close)
+        dead = '{}-{}'.format(socket.gethostname(), 2 ** 22 + 1)
+        self.assertTrue(db.acquire('job-lease', dead, 60))
+        self.assertTrue(sss._is_dead_local_owner(dead))
+        self.assertFalse(sss._is_dead_local_owner(sss._lease_owner()))
+        self.assertFalse(sss._is_dead_local_owner('other-host-1'))
+        self.assertFalse(db.acquire('job-lease', 'other-host-1', 60))
+        self.assertTrue(db.acquire('job-lease', sss._lease_owner(), 60,
+                                   sss._is_dead_local_owner))
+
+    def test_in_shard(self):
+        job_names = ['job-{}'.format(i) for i in range(20)]
+        shards = [[job_name for job_name in job_names
+                   if sss.in_shard(job_name, (index, 3))]
+                  for index in range(3)]
+        self.assertEqual(sorted(job_names), sorted(sum(shards, [])))
+        self.assertTrue(all(shards))
+        self.assertTrue(all(sss.in_shard(job_name, (0, 1))
+                            for job_name in job_names))
+
+    def test_shards_need_a_pickledb_per_shard(self):
+        argv = ['sss_jenkins', '--state-store', 'pickledb', '--shards', '2']
+        with mock.patch('sys.argv', argv), \
+                mock.patch('sss.run_shards') as mock_run_shards, \
+                mock.patch('sys.stderr'):
+            self.assertRaises(SystemExit, sss.process_jenkins_jobs)
+            argv += ['--state-path', 'sss_cache_{shard}.db']
+            sss.process_jenkins_jobs()
+        self.assertTrue(mock_run_shards.called)
+
+    def test_migrate_from_pickledb(self):
+        legacy_path = os.path.join(self.tmpdir, 'sss_cache.db')
+        with open(legacy_path, 'w') as fh:
+            json.dump({'job-7': True, '7-x86_64-merge': True}, fh)
+        db = sss.open_state_store('sqlite', self.path,
+                                  migrate_from=legacy_path)
+        self.assertTrue(db.get('job-7'))
+        self.assertTrue(db.get('7-x86_64-merge'))
+        db.set('job-8')
+        db.close()
+        # Only empty stores are migrated
+        with open(legacy_path, 'w') as fh:
+            json.dump({'job-9': True}, fh)
+        db = sss.open_state_store('sqlite', self.path,
+                                  migrate_from=legacy_path)
+        self.assertIsNone(db.get('job-9'))
+        db.close()
+
+
+class TestFetchLog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def mock_http(self, contents):
+        def get(url, **kwargs):
+            self.assertTrue(kwargs['stream'])
+            response = mock.Mock()
+            content = contents[url]
+            response.iter_content.return_value = [
+                content[i:i + 4] for i in range(0, len(content), 4)
+            ]
+            return response
+        http = mock.Mock()
+        http.get.side_effect = get
+        return mock.patch('sss.get_http_client', return_value=http)
+
+    def test_fetch_log_max_size(self):
+        metrics = sss.Metrics()
+        with self.mock_http({'url': b'0123456789'}), \
+                mock.patch('sss.METRICS', metrics):
+            filepath = sss._fetch_log('task.log', 'url', self.tmpdir, 6)
+        with open(filepath, 'rb') as fh:
+            self.assertEqual(b'012345' + sss.LOG_TRUNCATED_MARKER % 6,
+                             fh.read())
+        self.assertEqual(6, metrics.summary()['stages']['log_download']
+                         ['bytes'])
+
+    def test_fetch_logs(self):
+        contents = {'url{}'.format(i): str(i).encode() * 10
+                    for i in range(8)}
+        logs = [('{}.log'.format(i), 'url{}'.format(i)) for i in range(8)]
+        with self.mock_http(contents), \
+                mock.patch.dict(os.environ, {'SSS_LOG_WORKERS': '3'}):
+            filepaths = sss._fetch_logs(logs, self.tmpdir)
+        for i, filepath in enumerate(filepaths):
+            self.assertEqual('{}.log'.format(i), os.path.basename(filepath))
+            with open(filepath, 'rb') as fh:
+                self.assertEqual(str(i).encode() * 10, fh.read())
+
+
+class TestMultipartBody(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_multipart_body(self):
+        filepath = os.path.join(self.tmpdir, 'task.log')
+        with open(filepath, 'wb') as fh:
+            fh.write(b'log line\n' * 10000)
+        body = sss.MultipartBody([('tests', '{"/merge/": "pass"}')],
+                                 [('attachment', filepath)])
+        content = b''.join(body)
+        self.assertEqual(len(content), len(body))
+        # Every iteration sends the whole body again
+        self.assertEqual(content, b''.join(body))
+        msg = BytesParser().parsebytes(
+            'Content-Type: {}\r\n\r\n'.format(body.content_type).encode() +
+            content
+        )
+        tests, attachment = msg.get_payload()
+        self.assertEqual(b'{"/merge/": "pass"}',
+                         tests.get_payload(decode=True))
+        self.assertEqual('task.log', attachment.get_filename())
+        self.assertEqual(b'log line\n' * 10000,
+                         attachment.get_payload(decode=True))
+
+    def test_do_request_files(self):
+        filepath = os.path.join(self.tmpdir, 'task.log')
+        with open(filepath, 'wb') as fh:
+            fh.write(b'log')
+        env = {'AUTH_TOKEN': 'token', 'SQUAD_HOST': 'https://squad'}
+        with mock.patch.dict(os.environ, env), \
+                mock.patch('sss.get_http_client') as mock_http:
+            mock_http.return_value.post.return_value.text = ''
+            sss.do_request('api/submit', {}, {}, [filepath])
+        url, = mock_http.return_value.post.mock_calls[0][1]
+        kwargs = mock_http.return_value.post.mock_calls[0][2]
+        self.assertEqual('https://squad/api/submit', url)
+        self.assertEqual([('attachment', filepath)], kwargs['data'].files)
+        self.assertEqual(kwargs['data'].content_type,
+                         kwargs['headers']['Content-Type'])
+
+    def test_do_request_gzip_and_dedup(self):
+        filepaths = []
+        for name, content in (('a.log', b'same'), ('b.log', b'same'),
+                              ('c.log', b'other')):
+            filepaths.append(os.path.join(self.tmpdir, name))
+            with open(filepaths[-1], 'wb') as fh:
+                fh.write(content)
+        env = {
+            'AUTH_TOKEN': 'token',
+            'SQUAD_HOST': 'https://squad',
+            'SSS_GZIP_ATTACHMENTS': '1',
+            'SSS_ATTACHMENT_INDEX': os.path.join(self.tmpdir, 'index'),
+        }
+        sent = []
+
+        def post(url, **kwargs):
+            body = kwargs['data']
+            for name, filepath in body.files:
+                with gzip.open(filepath) as fh:
+                    sent.append((os.path.basename(filepath), fh.read()))
+            sent.append(json.loads(dict(body.fields)['metadata']))
+            return mock.Mock(text='')
+
+        with mock.patch.dict(os.environ, env), \
+                mock.patch('sss.get_http_client') as mock_http:
+            mock_http.return_value.post.side_effect = post
+            url = 'api/submit/KERNELCI/prj/e96d38e6/{}'
+            sss.do_request(url.format('x86_64'), {}, {'job_id': '1'},
+                           filepaths)
+            # Arches of the same build share their uploads, not other builds
+            sss.do_request(url.format('s390x'), {}, {'job_id': '2'},
+                           filepaths[2:])
+            sss.do_request('api/submit/KERNELCI/prj/0123abcd/s390x', {},
+                           {'job_id': '3'}, filepaths[2:])
+        self.assertEqual([
+            ('a.log.gz', b'same'),
+            ('c.log.gz', b'other'),
+            {'job_id': '1', 'duplicated_attachments': {'b.log': '1/a.log'}},
+            {'job_id': '2', 'duplicated_attachments': {'c.log': '1/c.log'}},
+            ('c.log.gz', b'other'),
+            {'job_id': '3'},
+        ], sent)
+        self.assertEqual(['a.log', 'b.log', 'c.log', 'index'],
+                         sorted(n for n in os.listdir(self.tmpdir)
+                                if not n.startswith('index-')))
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lru_eviction(self):
+        cache = sss.ResponseCache(self.tmpdir, max_size=10)
+        cache.put('a', [b'1234'])
+        cache.put('b', [b'1234'])
+        os.utime(cache.get('a'), (0, 0))
+        os.utime(cache.get('b'), (1, 1))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', [b'1234'])
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        with open(cache.get('c'), 'rb') as fh:
+            self.assertEqual(b'1234', fh.read())
+
+    def test_size_counted(self):
+        cache = sss.ResponseCache(self.tmpdir, max_size=10)
+        cache.put('a', [b'1234'])
+        with mock.patch('os.listdir', wraps=os.listdir) as mock_listdir:
+            cache.put('b', [b'1234'])
+            cache.put('b', [b'1234'])
+            self.assertFalse(mock_listdir.called)
+            cache.put('c', [b'1234'])
+            self.assertTrue(mock_listdir.called)
+        self.assertIsNone(cache.get('a'))
+
+    def test_body_bigger_than_cache(self):
+        cache = sss.ResponseCache(self.tmpdir, max_size=3)
+        path = cache.put('a', [b'<job/>'])
+        with open(path, 'rb') as fh:
+            self.assertEqual(b'<job/>', fh.read())
+        cache.put('b', [b'1'])
+        self.assertIsNone(cache.get('a'))
+
+    def test_ttl(self):
+        cache = sss.ResponseCache(self.tmpdir, max_size=10)
+        cache.put('running', [b'1'], ttl=-1)
+        cache.put('finished', [b'1'], ttl=-1)
+        cache.keep('finished')
+        self.assertIsNone(cache.get('running'))
+        self.assertIsNotNone(cache.get('finished'))
+
+    def test_revalidation(self):
+        cache = sss.ResponseCache(self.tmpdir, max_size=10)
+        cache.put('etag', [b'1'], ttl=-1, validators={'ETag': '"1"'})
+        cache.put('none', [b'1'], ttl=-1)
+        self.assertIsNone(cache.get('etag'))
+        self.assertEqual((None, None), cache.validators('none'))
+        path, validators = cache.validators('etag')
+        self.assertEqual({'If-None-Match': '"1"'},
+                         sss.conditional_headers(validators))
+        cache.refresh('etag', 60)
+        self.assertEqual(path, cache.get('etag'))
+
+    def test_jenkins_not_modified(self):
+        server = jenkins.Jenkins('http://jenkins')
+        responses = [
+            mock.Mock(status_code=200, content=b'{"builds": []}',
+                      text='{"builds": []}',
+                      headers={'ETag': '"1"', 'Last-Modified': 'Mon'}),
+            mock.Mock(status_code=304, headers={}),
+        ]
+        env = {'SSS_JENKINS_CACHE_DIR': self.tmpdir}
+        with mock.patch.object(server, 'jenkins_request') as mock_request, \
+                mock.patch.dict(os.environ, env):
+            mock_request.side_effect = responses
+            for i in range(2):
+                self.assertEqual([], sss.get_builds(server, 'job'))
+        self.assertEqual({}, mock_request.mock_calls[0][1][0].headers)
+        self.assertEqual({'If-None-Match': '"1"', 'If-Modified-Since': 'Mon'},
+                         mock_request.mock_calls[1][1][0].headers)
+
+    def test_beaker_responses(self):
+        recipeset = {'machine_recipes': [{'recipe_id': 3,
+                                          'status': 'Completed'}]}
+        with open(get_asset_path('recipe_0.xml'), 'rb') as fh:
+            recipe = fh.read()
+
+        def get(url, **kwargs):
+            response = mock.Mock(status_code=200, headers={})
+            if url.endswith('.xml'):
+                response.iter_content.return_value = [recipe]
+            else:
+                response.content = json.dumps(recipeset).encode()
+                response.json.return_value = recipeset
+            return response
+
+        env = {'SSS_BEAKER_CACHE_DIR': self.tmpdir}
+        with mock.patch('sss.get_http_client') as mock_http, \
+                mock.patch.dict(os.environ, env):
+            mock_http.return_value.get.side_effect = get
+            for i in range(2):
+                self.assertEqual(recipeset,
+                                 sss.get_recipeset('https://beaker', '2'))
+                self.assertEqual(3, len(sss.get_test_results(
+                    'https://beaker', '3')))
+            # Another server has recipes of its own
+            sss.get_recipeset('https://beaker2', '2')
+        self.assertEqual(['https://beaker/recipesets/2',
+                          'https://beaker/recipes/3.xml',
+                          'https://beaker2/recipesets/2'],
+                         [c[1][0] for c in mock_http.return_value.get.mock_calls
+                          if c[0] == ''])
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_outbox(self):
+        path = os.path.join(self.tmpdir, 'outbox')
+        filepath = os.path.join(self.tmpdir, 'task.log')
+        with open(filepath, 'w') as fh:
+            fh.write('log')
+        outbox = sss.Outbox(path, backoff=0)
+        outbox.put('api/submit', {'/merge/': 'pass'}, {'job_id': '1'})
+        outbox.put('api/submit', {'/kernel/a': 'PASS'}, {'job_id': '2'},
+                   [filepath], {'/kernel/a/duration': 1})
+        outbox.close()
+        self.assertFalse(os.path.exists(filepath))
+
+        submitted = []
+
+        def submit(url, test_result, metadata, files=None, metrics=None):
+            if metadata['job_id'] == '1' and not submitted:
+                submitted.append('failure')
+                raise Exception('Squad is down')
+            for filepath in files:
+                with open(filepath) as fh:
+                    self.assertEqual('log', fh.read())
+            submitted.append((url, test_result, metadata['job_id'],
+                              len(files), metrics))
+
+        # A restart resumes the outbox
+        outbox = sss.Outbox(path, backoff=0)
+        self.assertEqual(1, outbox.drain(submit))
+        self.assertEqual(1, len(outbox))
+        self.assertEqual(1, outbox.drain(submit))
+        self.assertEqual(0, len(outbox))
+        self.assertEqual([
+            'failure',
+            ('api/submit', {'/kernel/a': 'PASS'}, '2', 1,
+             {'/kernel/a/duration': 1}),
+            ('api/submit', {'/merge/': 'pass'}, '1', 0, {}),
+        ], submitted)
+        self.assertEqual([], os.listdir(outbox.spool))
+        outbox.close()
+
+    def test_dead_submissions(self):
+        outbox = sss.Outbox(os.path.join(self.tmpdir, 'outbox'), backoff=0,
+                            max_attempts=2)
+        self.addCleanup(outbox.close)
+        for job_id in ('rejected', 'down'):
+            outbox.put('api/submit', {}, {'job_id': job_id})
+
+        def submit(url, test_result, metadata, files=None, metrics=None):
+            if metadata['job_id'] == 'rejected':
+                response = mock.Mock(status_code=400)
+                raise requests.HTTPError('Bad Request', response=response)
+            raise requests.ConnectionError('Squad is down')
+
+        outbox.drain(submit)
+        self.assertEqual((1, 1), (len(outbox), outbox.dead()))
+        outbox.drain(submit)
+        self.assertEqual((0, 2), (len(outbox), outbox.dead()))
+        self.assertEqual(0, outbox.drain(submit))
+        self.assertEqual(2, outbox.retry_dead())
+        self.assertEqual(2, outbox.drain(mock.Mock()))
+        self.assertEqual((0, 0), (len(outbox), outbox.dead()))
+
+    def test_auth_errors_are_transient(self):
+        for status in (401, 403, 404):
+            error = requests.HTTPError(response=mock.Mock(status_code=status))
+            self.assertTrue(sss._is_transient(error))
+        error = requests.HTTPError(response=mock.Mock(status_code=400))
+        self.assertFalse(sss._is_transient(error))
+
+
+class TestHTTPClient(unittest.TestCase):
+    def test_session_per_host(self):
+        http = sss.HTTPClient(pool_size=4, retries=2)
+        squad = http.session('https://squad/api/submit/KERNELCI/prj')
+        self.assertIs(squad, http.session('https://squad/other'))
+        self.assertIsNot(squad, http.session('https://beaker/recipes/1.xml'))
+        adapter = squad.get_adapter('https://squad/')
+        self.assertEqual(4, adapter._pool_maxsize)
+        self.assertEqual(2, adapter.max_retries.total)
+        http.close()
+
+    def test_request_timeout(self):
+        http = sss.HTTPClient(timeout=5)
+        session = http.session('https://beaker')
+        with mock.patch.object(session, 'request') as mock_request:
+            http.get('https://beaker/recipes/1.xml')
+            http.get('https://beaker/recipes/2.xml', timeout=1)
+        self.assertEqual(5, mock_request.mock_calls[0][2]['timeout'])
+        self.assertEqual(1, mock_request.mock_calls[1][2]['timeout'])
+
+    def test_controlled_adapter(self):
+        http = sss.HTTPClient(concurrency=2)
+        adapter = http.session('https://squad').get_adapter('https://squad/')
+        self.assertIsInstance(adapter, sss.ControlledAdapter)
+        self.assertIs(http.controller, adapter.controller)
+
+    def test_body_holds_slot(self):
+        controller = sss.RateController(initial=4)
+        adapter = sss.ControlledAdapter(controller)
+        request = requests.Request('GET', 'https://beaker/logs/1').prepare()
+        response = mock.Mock(status_code=200, headers={})
+        release_conn = response.raw.release_conn
+        with mock.patch('requests.adapters.HTTPAdapter.send',
+                        return_value=response):
+            adapter.send(request, stream=True)
+            self.assertEqual(1, controller.limits()['beaker']['in_flight'])
+            response.raw.release_conn()
+            response.raw.release_conn()
+            self.assertEqual(0, controller.limits()['beaker']['in_flight'])
+            self.assertEqual(2, release_conn.call_count)
+            # requests reads the body after send returns
+            adapter.send(request)
+            self.assertEqual(1, controller.limits()['beaker']['in_flight'])
+            response.raw.release_conn()
+            self.assertEqual(0, controller.limits()['beaker']['in_flight'])
+
+
+class TestHostLimiter(unittest.TestCase):
+    def test_aimd(self):
+        limiter = sss.HostLimiter(initial=2, maximum=3)
+        limiter.acquire()
+        limiter.release(200, 0.1)
+        self.assertEqual(2.5, limiter.limit)
+        limiter.acquire()
+        limiter.release(200, 0.1)
+        limiter.acquire()
+        limiter.release(200, 0.1)
+        self.assertEqual(3, limiter.limit)
+        limiter.acquire()
+        limiter.release(503, 0.1)
+        self.assertEqual(1.5, limiter.limit)
+        # Decreased at most once per interval
+        limiter.acquire()
+        limiter.release(None, 0.1)
+        self.assertEqual(1.5, limiter.limit)
+        self.assertEqual(2, limiter.errors)
+
+    def test_slow_responses(self):
+        limiter = sss.HostLimiter(initial=10, latency_factor=2)
+        limiter.acquire()
+        limiter.release(200, 0.1)
+        limiter.acquire()
+        limiter.release(200, 10)
+        self.assertEqual(9, int(limiter.limit))
+
+    def test_limit_waits(self):
+        limiter = sss.HostLimiter(initial=1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release(200, 0.1)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+    def test_retry_after(self):
+        controller = sss.RateController(initial=4)
+        limiter = controller.limiter('squad')
+        limiter.acquire()
+        limiter.release(429, 0.1, retry_after=60)
+        self.assertGreater(limiter.blocked_until, time.time() + 50)
+        self.assertEqual({'squad': {'limit': 2, 'in_flight': 0,
+                                    'latency': None, 'errors': 1}},
+                         controller.limits())
+        limiter = sss.HostLimiter()
+        limiter.acquire()
+        limiter.release(429, 0.1, retry_after=86400)
+        self.assertLess(limiter.blocked_until,
+                        time.time() + limiter.MAX_RETRY_AFTER + 1)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_summary(self):
+        metrics = sss.Metrics()
+        metrics.add('squad_post', 0.5, 100)
+        metrics.add('squad_post', 1.5, 50)
+        with metrics.timer('jenkins_api'):
+            pass
+        metrics.count('beaker_cache_hits', 3)
+        metrics.count('beaker_cache_misses')
+        metrics.count('http_requests', host='squad')
+        metrics.count('http_requests', 2, host='beaker')
+        limits = {'squad': {'limit': 4, 'in_flight': 1}}
+        summary = metrics.summary(limits)
+        self.assertEqual({'calls': 2, 'seconds': 2.0, 'bytes': 150},
+                         summary['stages']['squad_post'])
+        self.assertEqual(1, summary['stages']['jenkins_api']['calls'])
+        self.assertEqual(3, summary['counters']['http_requests'])
+        self.assertEqual({'squad': 1, 'beaker': 2},
+                         summary['hosts']['http_requests'])
+        self.assertEqual({'beaker_cache': 0.75}, summary['hit_rates'])
+        self.assertEqual(limits, summary['limits'])
+        text = metrics.prometheus(limits)
+        self.assertIn('sss_stage_bytes_total{stage="squad_post"} 150', text)
+        self.assertIn('sss_http_requests_total{host="beaker"} 2', text)
+        self.assertIn('sss_beaker_cache_hits_total 3', text)
+        self.assertIn('sss_hit_rate{cache="beaker_cache"} 0.75', text)
+        self.assertIn('sss_host_limit{host="squad"} 4', text)
+
+    def test_timed_iterator(self):
+        chunks = sss.TimedIterator([b'ab', b'cde'])
+        self.assertEqual([b'ab', b'cde'], list(chunks))
+        self.assertEqual(5, chunks.size)
+
+    def test_serve_metrics(self):
+        server = sss.serve_metrics(0, lambda: {})
+        try:
+            response = requests.get('http://127.0.0.1:{}/metrics'.format(
+                server.server_address[1]
+            ))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(200, response.status_code)
+        self.assertIn('# TYPE sss_stage_seconds_total counter',
+                      response.text)
+
+    def test_profiler(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'sss.prof')
+        profiler = sss.Profiler()
+        profiler.start()
+        pool = ThreadPool(2)
+        pool.map(sss.parse_skt_rc, ['[state]\nstage = merge\n'] * 2)
+        pool.close()
+        pool.join()
+        profiler.dump(path)
+        import pstats
+        stats = pstats.Stats(path).stats
+        self.assertIn('parse_skt_rc', [func[2] for func in stats])